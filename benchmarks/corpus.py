@@ -0,0 +1,119 @@
+"""Generate synthetic Flekky source trees for benchmarking.
+
+Usage: python benchmarks/corpus.py DIRECTORY [options]
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import random
+from datetime import date, timedelta
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+CODE = '''```python
+def fib(n):
+    """Return the n-th fibonacci number."""
+    a, b = 0, 1
+    for i in range(n):
+        a, b = b, a + b
+    return a
+```'''
+
+
+def sentence(rand, length=12):
+    words = [rand.choice(WORDS) for i in range(length)]
+    return ' '.join(words).capitalize() + '.'
+
+
+def body(rand, sections, code_density, heading_depth):
+    parts = []
+    for i in range(sections):
+        level = i % heading_depth + 1
+        parts.append('#' * level + ' ' + sentence(rand, 4)[:-1])
+        parts.append(' '.join(sentence(rand) for j in range(5)))
+        if rand.random() < code_density:
+            parts.append(CODE)
+    return '\n\n'.join(parts)
+
+
+def generate(directory, pages=1000, tags=50, tags_per_page=3,
+             code_density=0.3, heading_depth=3, sections=5, seed=0):
+    """Create a source tree in ``directory``.
+
+    Templates and static files are copied from the example project.
+    """
+    rand = random.Random(seed)
+    example = os.path.join(root, '_example')
+    for name in ['templates', 'static']:
+        shutil.copytree(
+            os.path.join(example, name), os.path.join(directory, name))
+
+    def write(path, meta, content):
+        path = os.path.join(directory, 'pages', path + '.md')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as fh:
+            for key, value in meta:
+                fh.write('%s: %s\n' % (key, value))
+            fh.write('\n')
+            fh.write(content)
+
+    write('index', [('title', 'Benchmark'), ('layout', 'index')],
+          'Synthetic benchmark site.')
+
+    tag_names = ['tag%i' % i for i in range(tags)]
+    for tag in tag_names:
+        write('tag/' + tag, [('title', tag), ('layout', 'tag')], '')
+
+    start = date(2000, 1, 1)
+    for i in range(pages):
+        page_tags = rand.sample(tag_names, min(tags_per_page, tags))
+        write('posts/post%i' % i, [
+            ('title', sentence(rand, 5)[:-1]),
+            ('date', start + timedelta(days=i)),
+            ('tags', '[%s]' % ', '.join(page_tags)),
+        ], body(rand, sections, code_density, heading_depth))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory')
+    add_corpus_arguments(parser)
+    return parser.parse_args(argv)
+
+
+def add_corpus_arguments(parser):
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--tags', type=int, default=50)
+    parser.add_argument('--tags-per-page', type=int, default=3)
+    parser.add_argument('--code-density', type=float, default=0.3,
+                        help='probability of a code block per section')
+    parser.add_argument('--heading-depth', type=int, default=3)
+    parser.add_argument('--sections', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def corpus_kwargs(args):
+    return {
+        'pages': args.pages,
+        'tags': args.tags,
+        'tags_per_page': args.tags_per_page,
+        'code_density': args.code_density,
+        'heading_depth': args.heading_depth,
+        'sections': args.sections,
+        'seed': args.seed,
+    }
+
+
+def main():
+    args = parse_args()
+    generate(args.directory, **corpus_kwargs(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+"""Compare ``shift_headings`` to the previous BeautifulSoup implementation.
+
+Usage: python benchmarks/headings.py [sections]
+"""
+
+import os
+import sys
+import timeit
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from flekky.flekky import shift_headings  # noqa
+
+
+def shift_headings_bs4(html, offset):
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+
+    order = range(1, 6)
+    if offset > 0:
+        order = reversed(order)
+
+    for i in order:
+        j = min(max(i + offset, 1), 6)
+        for tag in soup.find_all('h%i' % i):
+            tag.name = 'h%i' % j
+
+    return str(soup)
+
+
+def document(sections):
+    parts = []
+    for i in range(sections):
+        parts.append('<h%i id="s%i">Section %i</h%i>' % (
+            i % 3 + 1, i, i, i % 3 + 1))
+        parts.append('<p>Lorem <em>ipsum</em> dolor sit amet, '
+                     '<a href="#s%i">consectetur</a> adipiscing elit.</p>' % i)
+        parts.append('<pre><code>for i in range(10):\n'
+                     '    print(i)</code></pre>')
+    return '\n'.join(parts)
+
+
+def main():
+    sections = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    html = document(sections)
+    print('document size: %i bytes' % len(html))
+
+    number = 10
+    t = timeit.timeit(lambda: shift_headings(html, 1), number=number)
+    print('shift_headings: %.2f ms' % (t / number * 1000))
+
+    try:
+        t_bs4 = timeit.timeit(
+            lambda: shift_headings_bs4(html, 1), number=number)
+    except ImportError:
+        print('BeautifulSoup is not installed, skipping comparison')
+    else:
+        print('BeautifulSoup:  %.2f ms (%.1fx)' % (
+            t_bs4 / number * 1000, t_bs4 / t))
+
+
+if __name__ == '__main__':
+    main()
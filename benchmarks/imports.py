@@ -0,0 +1,78 @@
+"""Measure how long it takes to start flekky.
+
+Every statement is run in a fresh interpreter and the fastest of
+``--repeat`` runs is reported (minus the startup time of python itself).
+With ``--max`` the script fails if the command line interface is slower,
+which can be used to guard against regressions.
+
+Usage: python benchmarks/imports.py [--repeat 10] [--max 50]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STATEMENTS = [
+    ('python', 'pass'),
+    ('cli', 'import flekky.cli'),
+    ('version', 'import sys; sys.argv = ["flekky", "--version"]\n'
+                'import flekky.cli\n'
+                'try:\n'
+                '    flekky.cli.main()\n'
+                'except SystemExit:\n'
+                '    pass'),
+    ('flekky', 'import flekky.flekky'),
+]
+
+
+def measure(statement, repeat):
+    """Return the fastest wall time of ``statement`` in a new interpreter."""
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for i in range(repeat):
+            start = time.time()
+            subprocess.check_call(
+                [sys.executable, '-c', statement], cwd=root, stdout=devnull)
+            seconds = time.time() - start
+            if best is None or seconds < best:
+                best = seconds
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', '-n', type=int, default=10)
+    parser.add_argument(
+        '--max', type=float, default=None,
+        help='fail if importing the command line interface takes longer '
+             'than this many milliseconds')
+    parser.add_argument('--output', '-o', default=None)
+    args = parser.parse_args()
+
+    results = {}
+    for name, statement in STATEMENTS:
+        results[name] = measure(statement, args.repeat)
+    baseline = results.pop('python')
+
+    for name, statement in STATEMENTS[1:]:
+        print('%-10s %8.1f ms' % (name, (results[name] - baseline) * 1000))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump({
+                'python': baseline,
+                'results': results,
+            }, fh, indent=2, sort_keys=True)
+
+    if args.max is not None and (results['cli'] - baseline) * 1000 > args.max:
+        print('importing flekky.cli is slower than %.1f ms' % args.max)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+"""Measure the per-render overhead of ``page_route`` and ``_site``.
+
+Usage: python benchmarks/render.py [source]
+"""
+
+import os
+import sys
+import timeit
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from flekky import flekky  # noqa
+
+# do not write compiled templates to _example/_cache
+flekky.FLEKKY_TEMPLATE_CACHE = False
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        root, '_example')
+    app = flekky.create_app(source)
+    app.config['FLATPAGES_AUTO_RELOAD'] = False
+    paths = [page.path for page in flekky.pages]
+
+    number = 1000
+    with app.test_request_context():
+        t = timeit.timeit(lambda: flekky._site(flekky.pages), number=number)
+        print('_site:      %.1f us' % (t / number * 1e6))
+
+        def render():
+            for path in paths:
+                flekky.page_route(path)
+
+        render()  # warm up markdown and template caches
+        t = timeit.timeit(render, number=number // 10)
+        print('page_route: %.1f us' % (t / (number // 10) / len(paths) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
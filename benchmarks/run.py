@@ -0,0 +1,146 @@
+"""Run the benchmark suite on a synthetic corpus and write JSON results.
+
+Usage: python benchmarks/run.py [options] [--output results.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import warnings
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from flekky import flekky  # noqa
+import corpus  # noqa
+from headings import document  # noqa
+
+# do not write compiled templates to the source directory
+flekky.FLEKKY_TEMPLATE_CACHE = False
+
+
+def measure(func):
+    """Return wall time and peak memory allocated by python for ``func``."""
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    count = func()
+    seconds = time.time() - start
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        'seconds': seconds,
+        'count': count,
+        'per_second': count / seconds if seconds else None,
+        'peak_memory': peak,
+    }
+
+
+def bench_freeze(source, destination):
+    class Settings(object):
+        FREEZER_DESTINATION = destination
+
+    def run():
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            return len(flekky.create_freezer(source, Settings).freeze())
+    return run
+
+
+def bench_shift_headings(sections):
+    html = document(sections)
+
+    def run():
+        for offset in range(1, 4):
+            flekky.shift_headings(html, offset)
+        return 3
+    return run
+
+
+def bench_queries(app):
+    pages = flekky.FlekkyPages(app)
+
+    def run():
+        tags = pages.values('tags', is_list=True)
+        count = 1
+        for tag in tags:
+            list(pages.by_key('tags', tag, is_list=True))
+            count += 1
+        return count
+    return run
+
+
+def bench_page_route(app):
+    def run():
+        count = 0
+        with app.test_request_context():
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                for page in flekky.pages:
+                    flekky.page_route(page.path)
+                    count += 1
+        return count
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    corpus.add_corpus_arguments(parser)
+    parser.add_argument('--output', '-o', default='bench_results.json')
+    parser.add_argument('--keep', action='store_true',
+                        help='do not remove the generated corpus')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='flekky-bench-')
+    source = os.path.join(tmp, 'source')
+    try:
+        corpus.generate(source, **corpus.corpus_kwargs(args))
+
+        results = {}
+        results['freeze'] = measure(
+            bench_freeze(source, os.path.join(tmp, 'build')))
+        results['shift_headings'] = measure(
+            bench_shift_headings(args.sections * 100))
+
+        app = flekky.create_app(source)
+        app.config['FLATPAGES_AUTO_RELOAD'] = False
+        results['queries'] = measure(bench_queries(app))
+        results['page_route'] = measure(bench_page_route(app))
+    finally:
+        if args.keep:
+            print('corpus kept in %s' % source)
+        else:
+            shutil.rmtree(tmp)
+
+    data = {
+        'flekky': flekky.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'corpus': corpus.corpus_kwargs(args),
+        'results': results,
+    }
+    with open(args.output, 'w') as fh:
+        json.dump(data, fh, indent=2, sort_keys=True)
+
+    for name in sorted(results):
+        result = results[name]
+        print('%-15s %8.3f s %10.1f/s' % (
+            name, result['seconds'], result['per_second'] or 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Command line interface of flekky.
+
+This module only imports the standard library so that ``--help``,
+``--version`` and ``init`` are fast.  :mod:`flekky.flekky` (and with it
+Flask, Flask-FlatPages and Frozen-Flask) is imported by the commands that
+need it.
+"""
+
+import os
+import argparse
+import cProfile
+import locale
+import shutil
+
+from . import __version__
+
+
+def _(s):
+    return s
+
+
+def _shard(value):
+    try:
+        index, count = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(_('expected I/N, e.g. 1/4'))
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(_('expected 1 <= I <= N'))
+    return index, count
+
+
+def parse_args(argv=None):
+    """Parse command line arguments.
+
+    Args:
+        argv (list): List of command line parameters.
+    """
+    parser = argparse.ArgumentParser(description=_(
+        'Static website generator inspired by jekyll based on flask.'))
+    parser.add_argument(
+        '--version', '-V', action='version', version=__version__)
+    parser.add_argument(
+        '--source', '-s', default='_source',
+        help=_('directory where Flekky will read files (default: _source)'))
+    parser.add_argument(
+        '--future', action='store_true', dest='FLEKKY_FUTURE',
+        help=_('include pages with dates in the future (default: false)'))
+    parser.add_argument(
+        '--unpublished', action='store_true', dest='FLEKKY_UNPUBLISHED',
+        help=_('include unpublished pages (default: false)'))
+    parser.add_argument(
+        '--html-cache', action='store_true', dest='FLEKKY_HTML_CACHE',
+        help=_('cache rendered markdown in <source>/_cache (default: false)'))
+    parser.add_argument(
+        '--lazy-pages', action='store_true', dest='FLEKKY_LAZY_PAGES',
+        help=_('only keep metadata of pages in memory (default: false)'))
+    subparsers = parser.add_subparsers(title=_('commands'))
+
+    parser_build = subparsers.add_parser(
+        'build', help=_('generate static sites'))
+    parser_build.add_argument(
+        '--destination', '-d', default=None,
+        help=_('directory where Flekky will write files '
+               '(default: <source>_build)'))
+    parser_build.add_argument(
+        '--incremental', '-i', action='store_true', dest='FLEKKY_INCREMENTAL',
+        help=_('only rebuild pages whose dependencies changed '
+               '(default: false)'))
+    parser_build.add_argument(
+        '--jobs', '-j', type=int, default=1, dest='FLEKKY_JOBS',
+        help=_('number of processes used for rendering (default: 1)'))
+    parser_build.add_argument(
+        '--compress', '-z', action='store_true', dest='FLEKKY_COMPRESS',
+        help=_('write gzip (and brotli) compressed copies of all text files '
+               '(default: false)'))
+    parser_build.add_argument(
+        '--fingerprint', action='store_true', dest='FLEKKY_FINGERPRINT',
+        help=_('add content hashes to the filenames of static files '
+               '(default: false)'))
+    parser_build.add_argument(
+        '--minify', action='store_true', dest='FLEKKY_MINIFY',
+        help=_('minify HTML and CSS (default: false)'))
+    parser_build.add_argument(
+        '--shard', type=_shard, default=None, dest='FLEKKY_SHARD',
+        metavar='I/N',
+        help=_('only build the I-th of N parts of the site; combine them '
+               'with "merge"'))
+    parser_build.add_argument(
+        '--search', action='store_true', dest='FLEKKY_SEARCH',
+        help=_('write a search index to /search/ (default: false)'))
+    parser_build.add_argument(
+        '--profile', action='store_true', dest='FLEKKY_PROFILE',
+        help=_('print timings and write them (and cProfile data) to '
+               '<source>/_cache (default: false)'))
+    parser_build.set_defaults(cmd='build')
+
+    parser_serve = subparsers.add_parser(
+        'serve', help=_('run a test server for development'))
+    parser_serve.add_argument('--port', '-p', type=int, default=8000)
+    parser_serve.add_argument(
+        '--no-watch', action='store_false', dest='watch',
+        help=_('reload all pages on every request instead of watching '
+               'for changes'))
+    parser_serve.set_defaults(cmd='serve')
+
+    parser_merge = subparsers.add_parser(
+        'merge', help=_('combine the output of sharded builds'))
+    parser_merge.add_argument(
+        'shards', nargs='+', help=_('destinations of the sharded builds'))
+    parser_merge.add_argument(
+        '--destination', '-d', default=None,
+        help=_('directory where Flekky will write files '
+               '(default: <source>_build)'))
+    parser_merge.set_defaults(cmd='merge')
+
+    parser_warm = subparsers.add_parser(
+        'warm', help=_('compile all templates (and render all pages if '
+                       '--html-cache is used) to speed up later builds'))
+    parser_warm.set_defaults(cmd='warm')
+
+    parser_build = subparsers.add_parser(
+        'init', help=_('bootstrap a new project'))
+    parser_build.set_defaults(cmd='init')
+
+    return parser.parse_args(argv)
+
+
+def main():  # pragma: no cover
+    # https://docs.python.org/3/library/locale.html#locale.setlocale
+    locale.setlocale(locale.LC_ALL, '')
+
+    args = parse_args()
+    source = os.path.abspath(args.source)
+
+    if args.cmd == 'init':
+        from pkg_resources import resource_filename
+        init = resource_filename('flekky', 'init')
+        shutil.copytree(init, source)
+        print(_('Created new project in %s.') % source)
+        return
+
+    # flask and friends are only imported for commands that need them
+    from . import flekky
+
+    if args.cmd == 'build':
+        if args.destination is None:
+            args.destination = '%s_build' % args.source
+        destination = os.path.abspath(args.destination)
+        args.FREEZER_DESTINATION = destination
+        # extra files are handled by flekky.sync_extra_files()
+        args.FREEZER_DESTINATION_IGNORE = [
+            '/' + filename for filename in flekky.extra_files(source)]
+        freezer = flekky.create_freezer(source, args)
+        if args.FLEKKY_PROFILE:
+            profile = cProfile.Profile()
+            profile.runcall(freezer.freeze)
+
+            cache_dir = freezer.app.config['FLEKKY_CACHE_DIR']
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            freezer.profiler.dump(os.path.join(cache_dir, 'profile.json'))
+            profile.dump_stats(os.path.join(cache_dir, 'profile.prof'))
+            print(freezer.profiler.summary())
+            print(_('Profile written to %s.') % cache_dir)
+        else:
+            freezer.freeze()
+
+        # copy all additional files (only once for sharded builds)
+        if args.FLEKKY_SHARD is None or args.FLEKKY_SHARD[0] == 1:
+            cache_dir = freezer.app.config['FLEKKY_CACHE_DIR']
+            flekky.sync_extra_files(
+                source, destination,
+                os.path.join(cache_dir, 'extra_files.json'))
+    elif args.cmd == 'merge':
+        if args.destination is None:
+            args.destination = '%s_build' % args.source
+        conflicts = flekky.merge_shards(
+            [os.path.abspath(shard) for shard in args.shards],
+            os.path.abspath(args.destination))
+        if conflicts:
+            for relpath in conflicts:
+                print(_('Conflict: %s') % relpath)
+            raise SystemExit(1)
+    elif args.cmd == 'serve':
+        app = flekky.create_app(source, args)
+        if args.watch:
+            watcher, live_reload = flekky.watch(app, source)
+            watcher.start()
+        app.run(port=args.port, threaded=True)
+    elif args.cmd == 'warm':
+        app = flekky.create_app(source, args)
+        templates, rendered = flekky.warm(app)
+        print(_('Compiled %i templates and rendered %i pages.') % (
+            templates, rendered))
+    else:
+        raise ValueError('invalid command: %s' % args.cmd)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
+
+# vim: set ts=4 sw=4 sts=4 et:
@@ -6,25 +6,79 @@
 # yet-powerful-static-website-generator-with-flask/.
 
 import os
-import argparse
+import calendar
+import errno
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import re
 import shutil
-import locale
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import date, datetime
-from pkg_resources import resource_filename
+from email.utils import formatdate
+from fnmatch import fnmatch
+from unicodedata import normalize
 
-from bs4 import BeautifulSoup
-
-from flask import Flask, Blueprint, render_template
-from flask import current_app, url_for
+from flask import Flask, Blueprint, Response, render_template
+from flask import current_app, url_for, request, g, has_request_context
+from flask import abort, send_file, stream_with_context
 from flask import Markup, escape
 from flask_flatpages import FlatPages, Page
-from flask_frozen import Freezer
-
-__version__ = '0.4.1'
+from flask_frozen import Freezer, walk_directory
+from flask_frozen import Page as FrozenPage
+from jinja2 import TemplateNotFound, meta
+from jinja2 import FileSystemBytecodeCache
+try:
+    from jinja2 import pass_context
+except ImportError:  # pragma: no cover
+    from jinja2 import contextfilter as pass_context
+from werkzeug.datastructures import ImmutableDict
+from werkzeug.utils import import_string
+
+from . import __version__
+# the command line interface lives in cli.py to keep startup fast
+from .cli import _, main, parse_args  # noqa
+
+try:
+    from html import unescape
+except ImportError:  # pragma: no cover
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
 
 DEBUG = True
 FLATPAGES_AUTO_RELOAD = DEBUG
 FLATPAGES_EXTENSION = ['.html', '.md']
+FLEKKY_TIME = None
+FLEKKY_INCREMENTAL = False
+FLEKKY_JOBS = 1
+FLEKKY_PROFILE = False
+FLEKKY_TAXONOMIES = None
+FLEKKY_FEED_SIZE = 20
+FLEKKY_SITEMAP_SIZE = 50000
+FLEKKY_HTML_CACHE = False
+FLEKKY_HTML_CACHE_SIZE = 100 * 1024 * 1024
+FLEKKY_LAZY_PAGES = False
+FLEKKY_LAZY_PAGES_CACHE = 256
+FLEKKY_TEMPLATE_CACHE = True
+FLEKKY_COMPRESS = False
+FLEKKY_FINGERPRINT = False
+FLEKKY_MINIFY = False
+FLEKKY_SHARD = None
+FLEKKY_SEARCH = False
+FLEKKY_SEARCH_PREFIX = 2
+FLEKKY_RESPONSE_CACHE = 256
+FLEKKY_IMAGE_WIDTHS = [320, 640, 960, 1280, 1920]
+FLEKKY_IMAGE_QUALITY = 80
+FLEKKY_COMPRESS_EXTENSIONS = [
+    '.html', '.css', '.js', '.xml', '.svg', '.json', '.txt']
 
 # http://pythonhosted.org/Markdown/extensions/#officially-supported-extensions
 FLATPAGES_MARKDOWN_EXTENSIONS = [
@@ -38,43 +92,653 @@ FLATPAGES_MARKDOWN_EXTENSIONS = [
     'toc',
 ]
 
-# https://docs.python.org/3/library/locale.html#locale.setlocale
-locale.setlocale(locale.LC_ALL, '')
-
 flekky = Blueprint('flekky', __name__)
+search_blueprint = Blueprint('search', __name__)
+
+_MISSING = object()
+
+# set while a profiled build is running
+_profiler = None
+
+
+def _hash(value):
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+
+def _tmp_path(path):
+    """Return a temporary path next to ``path`` for the current thread.
+
+    Files are written there and then renamed to ``path``, so that other
+    threads and processes never see partial files.
+    """
+    return '%s.%i.%i.tmp' % (
+        path, os.getpid(), threading.current_thread().ident)
+
+
+@contextmanager
+def _phase(name):
+    """Attribute the time spent in this block to a phase of the build."""
+    if _profiler is None:
+        yield
+    else:
+        with _profiler.phase(name):
+            yield
+
+
+def _count(name, hit):
+    """Count a cache hit or miss for the build profile."""
+    if _profiler is not None:
+        _profiler.count(name, hit)
 
 
-def _(s):
-    return s
+def _track(*dependency):
+    """Record a dependency of the page that is currently being rendered."""
+    if has_request_context():
+        dependencies = getattr(g, 'flekky_dependencies', None)
+        if dependencies is not None:
+            dependencies.append(dependency)
+
+
+# Comments and raw text elements are copied verbatim.  Other tags are matched
+# as a whole so that headings in attribute values are not touched.
+_HEADING_RE = re.compile(
+    r'<!--.*?-->|<(script|style)\b.*?</\1\s*>|'
+    r'<(/?)[hH]([1-6])(?=[\s/>])|<[^>]*>',
+    re.DOTALL | re.IGNORECASE)
 
 
 def shift_headings(html, offset):
+    """Shift all headings in ``html`` by ``offset`` levels in a single pass.
+
+    The resulting levels are clamped to the range 1-6.
+    """
     if offset == 0:
         return html
 
-    soup = BeautifulSoup(html, 'html.parser')
+    def replace(match):
+        if match.group(3) is None:
+            return match.group(0)
+        level = min(max(int(match.group(3)) + offset, 1), 6)
+        return '<%sh%i' % (match.group(2), level)
 
-    order = range(1, 6)
-    if offset > 0:
-        order = reversed(order)
+    return _HEADING_RE.sub(replace, html)
 
-    for i in order:
-        j = min(max(i + offset, 1), 6)
-        for tag in soup.find_all('h%i' % i):
-            tag.name = 'h%i' % j
 
-    return str(soup)
+def page_fix_outline(self, base_heading_level):
+    """Shift the headings of this page.
 
+    Results are cached for each level as long as the page's html does not
+    change.
+    """
+    html = self.html
+    cache = getattr(self, '_outline_cache', None)
+    if cache is None or cache[0] is not html:
+        cache = (html, {})
+        self._outline_cache = cache
 
-def page_fix_outline(self, base_heading_level):
-    return shift_headings(self.html, base_heading_level - 1)
+    _count('fix_outline', base_heading_level in cache[1])
+    if base_heading_level not in cache[1]:
+        with _phase('shift_headings'):
+            cache[1][base_heading_level] = shift_headings(
+                html, base_heading_level - 1)
+    return cache[1][base_heading_level]
 
 
 Page.fix_outline = page_fix_outline
 
 
+# Whitespace in text is collapsed.  Comments are removed, except for
+# conditional comments.  Preformatted and raw text elements are copied
+# verbatim (but stylesheets are minified).
+_MINIFY_HTML_RE = re.compile(
+    r'(<!--\[if.*?-->)|(<!--.*?-->)|'
+    r'(<(pre|textarea|script|style)\b[^>]*>)(.*?)(</\4\s*>)|'
+    r'(<[^>]*>)|(\s+)',
+    re.DOTALL | re.IGNORECASE)
+
+# Strings and comments starting with ``/*!`` are copied verbatim.  Other
+# comments are treated like whitespace, which is removed next to punctuation.
+_CSS_GAP = r'(?:\s|/\*(?!!)(?:[^*]|\*(?!/))*\*/)'
+_MINIFY_CSS_RE = re.compile(
+    r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|/\*!.*?\*/)|'
+    r'(?:%(gap)s|;)*;%(gap)s*(?=\})|'
+    r'%(gap)s*([{};,>])%(gap)s*|'
+    r'(%(gap)s+)' % {'gap': _CSS_GAP},
+    re.DOTALL)
+
+
+def _collapse(whitespace):
+    return '\n' if '\n' in whitespace else ' '
+
+
+def minify_html(html):
+    """Remove comments and collapse whitespace in a single pass."""
+    def replace(match):
+        if match.group(2) is not None:
+            return ''
+        elif match.group(3) is not None:
+            content = match.group(5)
+            if match.group(4).lower() == 'style':
+                content = minify_css(content)
+            return match.group(3) + content + match.group(6)
+        elif match.group(8) is not None:
+            return _collapse(match.group(8))
+        else:
+            return match.group(0)
+
+    return _MINIFY_HTML_RE.sub(replace, html)
+
+
+def minify_css(css):
+    """Remove comments and unnecessary whitespace in a single pass."""
+    def replace(match):
+        if match.group(1) is not None:
+            return match.group(1)
+        elif match.group(2) is not None:
+            return match.group(2)
+        elif match.group(3) is not None:
+            return ' '
+        else:
+            return ''
+
+    return _MINIFY_CSS_RE.sub(replace, css).strip()
+
+
+class LRUCache(object):
+    """Mapping that only keeps the ``maxsize`` most recently used items."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            return default
+        self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+
+class LazyPage(Page):
+    """Page that only keeps its metadata in memory.
+
+    The body is read from disk when it is accessed.  Body, HTML and shifted
+    outlines are kept in a cache of limited size that is shared by all pages
+    of a :class:`FlekkyPages` instance.
+    """
+
+    def __init__(self, path, meta, filename, html_renderer, flatpages):
+        self.path = path
+        self._meta = meta
+        self.filename = filename
+        self.html_renderer = html_renderer
+        self._flatpages = flatpages
+
+    def _cached(self, name, func):
+        cache = self._flatpages._lazy_cache
+        value = cache.get((self, name), _MISSING)
+        if value is _MISSING:
+            value = func()
+            cache.set((self, name), value)
+        return value
+
+    def _read_body(self):
+        encoding = self._flatpages.config('encoding')
+        with io.open(self.filename, encoding=encoding) as fh:
+            lines = iter(fh.read().split('\n'))
+        for line in lines:
+            if not line.strip():
+                break
+        return '\n'.join(lines)
+
+    @property
+    def body(self):
+        return self._cached('body', self._read_body)
+
+    @property
+    def html(self):
+        return self._cached('html', lambda: self.html_renderer(self))
+
+    @property
+    def _outline_cache(self):
+        return self._flatpages._lazy_cache.get((self, 'outline'))
+
+    @_outline_cache.setter
+    def _outline_cache(self, value):
+        self._flatpages._lazy_cache.set((self, 'outline'), value)
+
+
+class HtmlCache(object):
+    """On-disk cache for rendered HTML with a size limit.
+
+    When the cache grows beyond ``max_size`` bytes, the least recently used
+    entries are removed.  File modification times are used to record usage.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.html')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with io.open(path, encoding='utf-8') as fh:
+                html = fh.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            return None
+        return html
+
+    def set(self, key, html):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(key)
+        tmp = _tmp_path(path)
+        with io.open(tmp, 'w', encoding='utf-8') as fh:
+            fh.write(html)
+        os.rename(tmp, path)
+
+        if self._size is None:
+            self._size = sum(size for mtime, size, path in self._entries())
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_size:
+            self.evict()
+
+    def _entries(self):
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.html'):
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def evict(self):
+        """Remove least recently used entries until the size limit is met."""
+        entries = sorted(self._entries())
+        self._size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if self._size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self._size -= size
+
+
+def _renderer_key(html_renderer, flatpages):
+    """Describe everything that influences rendering apart from the body."""
+    import markdown
+    try:
+        import pygments
+        pygments_version = pygments.__version__
+    except ImportError:
+        pygments_version = None
+
+    extensions = []
+    for extension in flatpages.config('markdown_extensions'):
+        if hasattr(extension, 'getConfigs'):
+            cls = type(extension)
+            extension = (cls.__module__, cls.__name__, sorted(
+                extension.getConfigs().items()))
+        extensions.append(extension)
+
+    return [
+        getattr(html_renderer, '__module__', None),
+        getattr(html_renderer, '__name__', None),
+        extensions,
+        sorted(flatpages.config('extension_configs').items()),
+        getattr(markdown, '__version__', getattr(markdown, 'version', None)),
+        pygments_version,
+    ]
+
+
+class TaxonomyPage(Page):
+    """Virtual page for a value of a taxonomy (e.g. a tag).
+
+    ``items`` contains all pages with that value.
+    """
+
+    def __init__(self, path, meta, items):
+        super(TaxonomyPage, self).__init__(path, '', '', lambda page: '')
+        self.__dict__['meta'] = meta
+        self.items = items
+
+
+class Pagination(object):
+    """One page of a list of pages.
+
+    ``items`` contains the pages on page ``number``.  If :attr:`path` is set,
+    :meth:`url` returns the URL of another page of the same list.
+    """
+
+    def __init__(self, items, number, per_page, total, path=None):
+        self.items = items
+        self.number = number
+        self.per_page = per_page
+        self.total = total
+        self.pages = max(1, (total + per_page - 1) // per_page)
+        self.path = path
+
+    def __iter__(self):
+        return iter(self.items)
+
+    @property
+    def has_prev(self):
+        return self.number > 1
+
+    @property
+    def has_next(self):
+        return self.number < self.pages
+
+    def url(self, number):
+        if number == 1:
+            return url_for('flekky.page_route', path=self.path)
+        else:
+            return url_for('flekky.page_route', path=self.path, number=number)
+
+    @property
+    def prev_url(self):
+        if self.has_prev:
+            return self.url(self.number - 1)
+
+    @property
+    def next_url(self):
+        if self.has_next:
+            return self.url(self.number + 1)
+
+
+def _build_index(included, key, is_list):
+    """Map values of ``key`` to positions of pages in ``included``.
+
+    Pages without ``key`` are stored with the special value ``_MISSING``.
+    Returns ``None`` if the values can not be indexed.
+    """
+    index = {}
+    try:
+        for i, page in enumerate(included):
+            if is_list:
+                values = page.meta.get(key, [])
+                if not isinstance(values, (list, tuple, set)):
+                    raise TypeError(values)
+                for value in values:
+                    positions = index.setdefault(value, [])
+                    if not positions or positions[-1] != i:
+                        positions.append(i)
+            else:
+                value = page.meta.get(key, _MISSING)
+                index.setdefault(value, []).append(i)
+    except TypeError:
+        return None
+    return index
+
+
 class FlekkyPages(FlatPages):
-    """Flat Pages with some extra features for Jekyll compatibility."""
+    """Flat Pages with some extra features for Jekyll compatibility.
+
+    The list of included pages, a mapping from path to included page and an
+    index for every key that is used with :meth:`by_key` or :meth:`values`
+    are computed once and reused until the pages are reloaded with actual
+    changes or the configuration changes.  They are rebuilt by one thread at
+    a time and only published once they are complete, so that concurrent
+    requests never see a half-built state.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._generation = 0
+        self._state_key = None
+        self._state_pages = None
+        self._state_lock = threading.Lock()
+        self._included = []
+        self._visible = {}
+        self._indexes = {}
+        self._views = {}
+        self._virtual = {}
+        self.html_cache = None
+        self._lazy_cache = LRUCache(0)
+        super(FlekkyPages, self).__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        super(FlekkyPages, self).init_app(app)
+        self._generation += 1
+        self._lazy_cache = LRUCache(app.config.get(
+            'FLEKKY_LAZY_PAGES_CACHE', FLEKKY_LAZY_PAGES_CACHE))
+        if app.config.get('FLEKKY_HTML_CACHE'):
+            self.html_cache = HtmlCache(
+                os.path.join(app.config['FLEKKY_CACHE_DIR'], 'html'),
+                app.config['FLEKKY_HTML_CACHE_SIZE'])
+        else:
+            self.html_cache = None
+
+    def _smart_html_renderer(self, html_renderer):
+        """Wrap the HTML renderer to use :attr:`html_cache` if enabled."""
+        render = super(FlekkyPages, self)._smart_html_renderer(html_renderer)
+
+        def wrapper(page):
+            cache = self.html_cache
+            if cache is None:
+                with _phase('markdown'):
+                    return render(page)
+
+            key = _hash([page.body, _renderer_key(html_renderer, self)])
+            html = cache.get(key)
+            _count('html_cache', html is not None)
+            if html is None:
+                with _phase('markdown'):
+                    html = render(page)
+                cache.set(key, html)
+            return html
+        return wrapper
+
+    def _load_file(self, path, filename):
+        cached = self._file_cache.get(filename)
+        if self.app.config.get('FLEKKY_LAZY_PAGES'):
+            page = self._load_header(path, filename)
+        else:
+            page = super(FlekkyPages, self)._load_file(path, filename)
+        if cached is None or cached[0] is not page:
+            self._generation += 1
+        return page
+
+    def _load_header(self, path, filename):
+        """Like :meth:`_load_file`, but only read the metadata."""
+        mtime = os.path.getmtime(filename)
+        cached = self._file_cache.get(filename)
+
+        if cached and cached[1] == mtime and isinstance(cached[0], LazyPage):
+            return cached[0]
+
+        lines = []
+        with io.open(filename, encoding=self.config('encoding')) as fh:
+            for line in fh:
+                if not line.strip():
+                    break
+                lines.append(line.rstrip('\n'))
+
+        html_renderer = self.config('html_renderer')
+        if not callable(html_renderer):
+            html_renderer = import_string(html_renderer)
+        html_renderer = self._smart_html_renderer(html_renderer)
+
+        page = LazyPage(path, '\n'.join(lines), filename, html_renderer, self)
+        self._file_cache[filename] = (page, mtime)
+        return page
+
+    def update(self, filenames):
+        """Reload only the pages for the given (changed) files.
+
+        Files that are not pages (e.g. swap and backup files of editors) are
+        ignored.  If a directory that exists or that contained pages changed
+        (e.g. it was moved or deleted), all pages are reloaded.
+        """
+        root = os.path.abspath(self.root)
+        extension = self.config('extension')
+        if isinstance(extension, str):
+            extension = extension.split(',')
+
+        pages = dict(self._pages)
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            relpath = os.path.relpath(filename, root)
+            if relpath.startswith(os.pardir):
+                continue
+
+            matches = [e for e in extension if relpath.endswith(e)]
+            if not matches:
+                prefix = filename + os.sep
+                if os.path.isdir(filename) or any(
+                        f.startswith(prefix) for f in self._file_cache):
+                    self.reload()
+                    return
+                continue
+
+            path = '/'.join(relpath[:-len(matches[0])].split(os.sep))
+            if self.config('case_insensitive'):
+                path = path.lower()
+            if os.path.isfile(filename):
+                pages[path] = self._load_file(path, filename)
+            else:
+                pages.pop(path, None)
+                self._file_cache.pop(filename, None)
+                self._generation += 1
+        self.__dict__['_pages'] = pages
+
+    def _state(self):
+        """Return all included pages except index in a stable order."""
+        config = self.app.config
+        all_pages = self._pages
+        key = (
+            # the generation may change before the new pages are published
+            id(all_pages),
+            self._generation,
+            len(all_pages),
+            date.today(),
+            config.get('FLEKKY_UNPUBLISHED', False),
+            config.get('FLEKKY_FUTURE', False),
+            repr(config.get('FLEKKY_TAXONOMIES')),
+        )
+        if key != self._state_key:
+            with self._state_lock:
+                if key != self._state_key:
+                    self._build_state(key, all_pages)
+        return self._included
+
+    def _build_state(self, key, all_pages):
+        visible = dict((path, page)
+                       for path, page in all_pages.items()
+                       if self._is_included(page))
+        # sorted by path so the order does not depend on the filesystem
+        included = sorted(
+            (p for p in visible.values() if p.path != 'index'),
+            key=lambda p: p.path)
+        indexes = {}
+        virtual = self._add_taxonomies(all_pages, included, indexes)
+        visible.update(virtual)
+
+        self._views = {}
+        self._indexes = indexes
+        self._virtual = virtual
+        self._included = included
+        self._visible = visible
+        # keep a reference so that the id in the key can not be reused
+        self._state_pages = all_pages
+        self._state_key = key
+
+    def taxonomies(self):
+        """Return the taxonomy configuration.
+
+        Taxonomies are read from ``FLEKKY_TAXONOMIES`` or, if that is not
+        set, from the ``taxonomies`` field of the index page.
+        """
+        taxonomies = self.app.config.get('FLEKKY_TAXONOMIES')
+        if taxonomies is None:
+            index = self._pages.get('index')
+            taxonomies = index.meta.get('taxonomies') if index else None
+
+        result = {}
+        for key, options in (taxonomies or {}).items():
+            options = dict(options or {})
+            options.setdefault('path', key)
+            options.setdefault('layout', 'default')
+            options.setdefault('is_list', False)
+            options.setdefault('per_page', None)
+            options.setdefault('sort', None)
+            options.setdefault('reverse', False)
+            result[key] = options
+        return result
+
+    def _add_taxonomies(self, all_pages, included, indexes):
+        """Create a virtual page for every value of every taxonomy.
+
+        Values that already have a real page at the same path are skipped.
+        Member pages are grouped by the index for that key, i.e. in a single
+        pass over all pages.  Virtual pages are not part of the page list
+        itself.  The indexes are added to ``indexes``.
+        """
+        virtual = {}
+        for key, options in sorted(self.taxonomies().items()):
+            view = (key, options['is_list'])
+            if view not in indexes:
+                indexes[view] = _build_index(included, *view)
+            index = indexes[view]
+            if index is None:
+                continue
+            for value, positions in index.items():
+                if value is _MISSING:
+                    continue
+                path = '%s/%s' % (options['path'], value)
+                if path in all_pages or path in virtual:
+                    continue
+                meta = {
+                    'title': value,
+                    'layout': options['layout'],
+                    'taxonomy': key,
+                }
+                if options['per_page']:
+                    meta['paginate'] = {
+                        'key': key,
+                        'value': value,
+                        'is_list': options['is_list'],
+                        'per_page': options['per_page'],
+                        'sort': options['sort'],
+                        'reverse': options['reverse'],
+                    }
+                items = [included[i] for i in positions]
+                virtual[path] = TaxonomyPage(path, meta, items)
+        return virtual
+
+    def virtual_pages(self):
+        """Return the pages that have been created for taxonomies."""
+        self._state()
+        return [self._virtual[path] for path in sorted(self._virtual)]
+
+    def _index(self, key, is_list):
+        """Return the (cached) result of :func:`_build_index`."""
+        included = self._state()
+        indexes = self._indexes
+        if (key, is_list) not in indexes:
+            indexes[(key, is_list)] = _build_index(included, key, is_list)
+        return indexes[(key, is_list)]
 
     def _is_included(self, page):
         if not page:
@@ -92,32 +756,212 @@ class FlekkyPages(FlatPages):
         return True
 
     def get(self, path, default=None):
-        page = super(FlekkyPages, self).get(path)
-
-        if self._is_included(page):
-            return page
-        else:
-            return default
+        _track('get', path)
+        with _phase('queries'):
+            return self._get(path, default=default)
 
     def __iter__(self):
-        for page in super(FlekkyPages, self).__iter__():
-            if self._is_included(page) and page.path != 'index':
-                yield page
+        _track('iter')
+        with _phase('queries'):
+            return self._iter()
+
+    def __len__(self):
+        _track('iter')
+        return len(self._state())
+
+    def __bool__(self):
+        # Flask-FlatPages checks instances for truth (e.g. in the markdown
+        # renderer).  That should not depend on the number of pages.
+        return True
+
+    __nonzero__ = __bool__
+
+    def __getitem__(self, index):
+        """Return the included page at ``index`` (or a list for slices)."""
+        _track('iter')
+        return self._state()[index]
+
+    def by_date(self, reverse=True):
+        """Return all pages with a date, sorted by date (newest first).
+
+        The result is a list that is computed once until the pages change,
+        so ``site.pages.by_date()[:10]`` is cheap.
+        """
+        _track('sorted_by', 'date', reverse)
+        with _phase('queries'):
+            return self._sorted_by('date', reverse)
+
+    def sorted_by(self, key, reverse=False):
+        """Return all pages that have ``key``, sorted by its value.
+
+        Like :meth:`by_date`, the result is cached.
+        """
+        _track('sorted_by', key, reverse)
+        with _phase('queries'):
+            return self._sorted_by(key, reverse)
+
+    def next_page(self, page, key='date'):
+        """Return the page after ``page`` in :meth:`sorted_by` ``key``.
+
+        For dates, this is the next newer page.  Returns ``None`` for the
+        last page.
+        """
+        _track('neighbour', page.path, key, 1)
+        with _phase('queries'):
+            return self._neighbour(page.path, key, 1)
+
+    def prev_page(self, page, key='date'):
+        """Return the page before ``page`` in :meth:`sorted_by` ``key``."""
+        _track('neighbour', page.path, key, -1)
+        with _phase('queries'):
+            return self._neighbour(page.path, key, -1)
 
     def by_key(self, key, value, default=None, is_list=False):
-        if is_list:
-            return (p for p in self if value in p.meta.get(key, []))
-        else:
-            return (p for p in self if value == p.meta.get(key, default))
+        _track('by_key', key, value, default, is_list)
+        with _phase('queries'):
+            return self._by_key(key, value, default=default, is_list=is_list)
 
     def values(self, key, is_list=False):
-        if is_list:
+        _track('values', key, is_list)
+        with _phase('queries'):
+            return self._values(key, is_list=is_list)
+
+    def paginate(self, number, per_page, key=None, value=None, default=None,
+                 is_list=False, sort=None, reverse=False):
+        """Return page ``number`` of all pages or of :meth:`by_key`.
+
+        Pages are ordered by path or, if ``sort`` is given, like
+        :meth:`sorted_by`.
+        """
+        _track('paginate', number, per_page, key, value, default, is_list,
+               sort, reverse)
+        with _phase('queries'):
+            return self._paginate(number, per_page, key=key, value=value,
+                                  default=default, is_list=is_list,
+                                  sort=sort, reverse=reverse)
+
+    # The following methods do the actual work.  Unlike their public
+    # counterparts they are not tracked as dependencies of the current page.
+
+    def _get(self, path, default=None):
+        self._state()
+        return self._visible.get(path, default)
+
+    def _iter(self):
+        return iter(self._state())
+
+    def _sorted_by(self, key, reverse=False):
+        included = self._state()
+        views = self._views
+        view = ('sorted_by', key, reverse)
+        if view not in views:
+            def sort_key(page):
+                value = page.meta[key]
+                # dates and datetimes can not be compared directly
+                if isinstance(value, date):
+                    return _datetime(value)
+                return value
+
+            matches = [p for p in included if key in p.meta]
+            # sorted() is stable, so pages with equal values keep their order
+            views[view] = sorted(matches, key=sort_key, reverse=reverse)
+        return views[view]
+
+    def _neighbour(self, path, key, offset):
+        matches = self._sorted_by(key)
+        view = ('positions', key)
+        if view not in self._views:
+            self._views[view] = dict(
+                (p.path, i) for i, p in enumerate(matches))
+
+        i = self._views[view].get(path)
+        if i is None or not 0 <= i + offset < len(matches):
+            return None
+        return matches[i + offset]
+
+    def _positions(self, key, value, default=None, is_list=False):
+        """Return the positions of matching pages in :meth:`_state`.
+
+        Returns ``None`` if there is no index or ``value`` is unhashable.
+        """
+        index = self._index(key, is_list)
+        try:
+            positions = index[value] if value in index else []
+            if not is_list and value == default and _MISSING in index:
+                positions = list(heapq.merge(positions, index[_MISSING]))
+        except TypeError:
+            return None
+        return positions
+
+    def _by_key(self, key, value, default=None, is_list=False):
+        positions = self._positions(key, value, default, is_list)
+        if positions is None:
+            if is_list:
+                return (p for p in self._iter()
+                        if value in p.meta.get(key, []))
+            else:
+                return (p for p in self._iter()
+                        if value == p.meta.get(key, default))
+        included = self._included
+        return (included[i] for i in positions)
+
+    def _paginate(self, number, per_page, key=None, value=None,
+                  default=None, is_list=False, sort=None, reverse=False):
+        start = (number - 1) * per_page
+        end = start + per_page
+        if sort is not None:
+            matches = self._sorted_by(sort, reverse)
+            if key is not None:
+                selected = set(id(p) for p in self._by_key(
+                    key, value, default, is_list))
+                matches = [p for p in matches if id(p) in selected]
+        elif key is None:
+            matches = self._state()
+        else:
+            positions = self._positions(key, value, default, is_list)
+            if positions is None:
+                matches = list(self._by_key(key, value, default, is_list))
+            else:
+                included = self._included
+                return Pagination(
+                    [included[i] for i in positions[start:end]],
+                    number, per_page, len(positions))
+        return Pagination(matches[start:end], number, per_page, len(matches))
+
+    def paginate_page(self, page, number=1):
+        """Paginate the pages selected by the ``paginate`` metadata of page.
+
+        Returns ``None`` if ``page`` is not paginated.
+        """
+        options = page.meta.get('paginate')
+        if options is None:
+            return None
+        if not isinstance(options, dict):
+            options = {'per_page': options}
+
+        pagination = self.paginate(
+            number,
+            options.get('per_page', 10),
+            key=options.get('key'),
+            value=options.get('value'),
+            default=options.get('default'),
+            is_list=options.get('is_list', False),
+            sort=options.get('sort'),
+            reverse=options.get('reverse', False))
+        pagination.path = page.path
+        return pagination
+
+    def _values(self, key, is_list=False):
+        index = self._index(key, is_list)
+        if index is not None:
+            return set(value for value in index if value is not _MISSING)
+        elif is_list:
             values = set()
-            for page in self:
+            for page in self._iter():
                 values.update(set(page.meta.get(key, [])))
             return values
         else:
-            return set([p.meta[key] for p in self if key in p.meta])
+            return set([p.meta[key] for p in self._iter() if key in p.meta])
 
 
 pages = FlekkyPages()
@@ -154,31 +998,443 @@ def filter_link_page(page):
         return Markup('<a href="%s">%s</a>' % (href, escape(text)))
 
 
+@flekky.app_template_filter('responsive_image')
+@pass_context
+def filter_responsive_image(context, filename, alt='', sizes='100vw',
+                            **attrs):
+    """Convert the name of an image in the static folder to HTML markup.
+
+    The image is available in several widths (``srcset``) and formats
+    (``<picture>``) as configured by ``FLEKKY_IMAGE_WIDTHS``.  If the image
+    can not be processed (e.g. because Pillow is not installed), a plain
+    ``<img>`` is returned instead.
+
+    The template context is not used, but it keeps Jinja from rendering
+    the markup at compile time (and storing it in the template cache).
+    """
+    images = current_app.extensions['flekky_images']
+    _track('image', filename)
+    variants = images.variants(filename)
+    extra = ''.join(' %s="%s"' % (escape(key), escape(value))
+                    for key, value in sorted(attrs.items()))
+    if not variants:
+        return Markup('<img src="%s" alt="%s"%s>' % (
+            url_for('static', filename=filename), escape(alt), extra))
+
+    srcsets = OrderedDict()
+    for width, fmt in variants:
+        images.add(filename, width, fmt)
+        url = url_for('flekky.image_route',
+                      filename=filename, width=width, fmt=fmt)
+        srcsets.setdefault(fmt, []).append('%s %iw' % (url, width))
+
+    # the last variant is the original format in the original width
+    entry = images.source(filename)
+    html = ('<img src="%s" srcset="%s" sizes="%s" width="%i" height="%i" '
+            'alt="%s"%s>' % (url, ', '.join(srcsets.pop(fmt)), escape(sizes),
+                             entry[3], entry[4], escape(alt), extra))
+    if srcsets:
+        sources = ''.join(
+            '<source type="image/%s" srcset="%s" sizes="%s">' % (
+                _fmt, ', '.join(srcset), escape(sizes))
+            for _fmt, srcset in srcsets.items())
+        html = '<picture>%s%s</picture>' % (sources, html)
+    return Markup(html)
+
+
 def _site(_pages):
     """Construct site wide variables.
 
     ... as opposed to page specific variables.
+
+    The result is shared by all renders until the pages change.  ``time`` is
+    taken from ``FLEKKY_TIME`` if set (e.g. the start of a build), otherwise
+    it is the time when the pages were last changed.
     """
+    index = _pages.get('index')
+    _pages._state()
+    key = (_pages._state_key, index, current_app._get_current_object())
+
+    cached = getattr(_pages, '_site_cache', None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
     site = {
         'title': 'Flekky',
-        'time': datetime.now(),
+        'time': current_app.config.get('FLEKKY_TIME') or datetime.now(),
         'pages': _pages,
         'config': current_app.config,
     }
 
-    index = _pages.get('index')
     if hasattr(index, 'meta'):
         site.update(index.meta)
 
+    site = ImmutableDict(site)
+    _pages._site_cache = (key, site)
     return site
 
 
 @flekky.route('/', defaults={'path': 'index'})
 @flekky.route('/<path:path>/')
-def page_route(path):
-    page = pages.get_or_404(path)
+@flekky.route('/page/<int:number>/', defaults={'path': 'index'})
+@flekky.route('/<path:path>/page/<int:number>/')
+def page_route(path, number=None):
+    if number is not None:
+        page = pages.get(path)
+        pagination = page and pages.paginate_page(page, number)
+        if pagination is None or not 1 < number <= pagination.pages:
+            # there may be a real page at that URL
+            if path == 'index':
+                return page_route('page/%i' % number)
+            return page_route('%s/page/%i' % (path, number))
+    else:
+        page = pages.get_or_404(path)
+        pagination = pages.paginate_page(page)
+
     template = 'layout/%s.html' % page.meta.get('layout', 'default')
-    return render_template(template, page=page, site=_site(pages))
+    _track('template', template)
+    if _profiler is not None:
+        _profiler.set_template(template)
+    site = _site(pages)
+    with _phase('template'):
+        return render_template(
+            template, page=page, site=site, pagination=pagination)
+
+
+def _datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime(value.year, value.month, value.day)
+
+
+def base_url():
+    """Return the ``url`` field of ``index.md`` or ``None`` if it is not set.
+
+    Feeds and sitemaps need absolute URLs, so they are only available if
+    the base URL is set.
+    """
+    index = pages._get('index')
+    return index.meta.get('url') if index else None
+
+
+def _require_base_url():
+    _track('get', 'index')
+    if not base_url():
+        abort(404)
+
+
+def _absolute_url(url):
+    """Make a URL absolute using :func:`base_url`."""
+    return base_url().rstrip('/') + url
+
+
+def _page_url(page):
+    return _absolute_url(url_for('flekky.page_route', path=page.path))
+
+
+def _xml_response(chunks):
+    """Stream XML so that large documents are never kept in memory."""
+    return Response(
+        stream_with_context(chunks), mimetype='application/xml')
+
+
+def _sitemap_pages():
+    """Yield all pages in the sitemap (index, pages, taxonomies)."""
+    index = pages._get('index')
+    if index is not None:
+        yield index
+    for page in pages._iter():
+        yield page
+    for page in pages.virtual_pages():
+        yield page
+
+
+def sitemap_shards():
+    """Number of sitemap files, or 0 if a single sitemap is sufficient."""
+    size = current_app.config['FLEKKY_SITEMAP_SIZE']
+    total = len(pages._state()) + len(pages._virtual) + 1
+    if total <= size:
+        return 0
+    return (total + size - 1) // size
+
+
+def _sitemap_urlset(items):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for page in items:
+        yield '<url><loc>%s</loc>' % escape(_page_url(page))
+        if 'date' in page.meta:
+            yield '<lastmod>%s</lastmod>' % (
+                page.meta['date'].strftime('%Y-%m-%d'))
+        yield '</url>\n'
+    yield '</urlset>\n'
+
+
+def _sitemap_index(shards):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield ('<sitemapindex '
+           'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    for number in range(1, shards + 1):
+        url = _absolute_url(url_for('flekky.sitemap_shard', number=number))
+        yield '<sitemap><loc>%s</loc></sitemap>\n' % escape(url)
+    yield '</sitemapindex>\n'
+
+
+@flekky.route('/sitemap.xml')
+def sitemap():
+    _require_base_url()
+    _track('iter')
+    shards = sitemap_shards()
+    if shards:
+        return _xml_response(_sitemap_index(shards))
+    return _xml_response(_sitemap_urlset(_sitemap_pages()))
+
+
+@flekky.route('/sitemap-<int:number>.xml')
+def sitemap_shard(number):
+    _require_base_url()
+    _track('iter')
+    shards = sitemap_shards()
+    if not 1 <= number <= shards:
+        abort(404)
+    size = current_app.config['FLEKKY_SITEMAP_SIZE']
+    items = itertools.islice(
+        _sitemap_pages(), (number - 1) * size, number * size)
+    return _xml_response(_sitemap_urlset(items))
+
+
+def feed_pages():
+    """Return the newest pages with a date, newest first."""
+    return pages._sorted_by('date', True)[
+        :current_app.config['FLEKKY_FEED_SIZE']]
+
+
+def _atom(items, site):
+    if items:
+        updated = _datetime(items[0].meta['date'])
+    else:
+        updated = site['time']
+    fmt = '%Y-%m-%dT%H:%M:%SZ'
+
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    yield '<title>%s</title>\n' % escape(site['title'])
+    home = escape(_absolute_url(url_for('flekky.page_route')))
+    yield '<id>%s</id>\n' % home
+    yield '<link href="%s"/>\n' % home
+    yield '<updated>%s</updated>\n' % updated.strftime(fmt)
+    yield '<author><name>%s</name></author>\n' % escape(
+        site.get('author', site['title']))
+    for page in items:
+        url = escape(_page_url(page))
+        yield '<entry>\n'
+        yield '<title>%s</title>\n' % escape(page.meta.get('title', ''))
+        yield '<id>%s</id>\n' % url
+        yield '<link href="%s"/>\n' % url
+        yield '<updated>%s</updated>\n' % (
+            _datetime(page.meta['date']).strftime(fmt))
+        if 'author' in page.meta:
+            yield '<author><name>%s</name></author>\n' % escape(
+                page.meta['author'])
+        yield '<content type="html">%s</content>\n' % escape(page.html)
+        yield '</entry>\n'
+    yield '</feed>\n'
+
+
+def _rss(items, site):
+    def rfc822(value):
+        return formatdate(
+            calendar.timegm(_datetime(value).timetuple()), usegmt=True)
+
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<rss version="2.0">\n<channel>\n'
+    yield '<title>%s</title>\n' % escape(site['title'])
+    yield '<link>%s</link>\n' % escape(
+        _absolute_url(url_for('flekky.page_route')))
+    yield '<description>%s</description>\n' % escape(
+        site.get('description', site['title']))
+    for page in items:
+        url = escape(_page_url(page))
+        yield '<item>\n'
+        yield '<title>%s</title>\n' % escape(page.meta.get('title', ''))
+        yield '<link>%s</link>\n' % url
+        yield '<guid>%s</guid>\n' % url
+        yield '<pubDate>%s</pubDate>\n' % rfc822(page.meta['date'])
+        yield '<description>%s</description>\n' % escape(page.html)
+        yield '</item>\n'
+    yield '</channel>\n</rss>\n'
+
+
+@flekky.route('/atom.xml')
+def atom():
+    _require_base_url()
+    _track('iter')
+    return _xml_response(_atom(feed_pages(), _site(pages)))
+
+
+@flekky.route('/rss.xml')
+def rss():
+    _require_base_url()
+    _track('iter')
+    return _xml_response(_rss(feed_pages(), _site(pages)))
+
+
+@flekky.route('/images/<path:filename>/<int:width>.<any(jpeg, png, webp):fmt>')
+def image_route(filename, width, fmt):
+    images = current_app.extensions['flekky_images']
+    if (width, fmt) not in images.variants(filename):
+        abort(404)
+    return send_file(
+        images.get(filename, width, fmt), mimetype='image/%s' % fmt)
+
+
+_TEXT_RE = re.compile(
+    r'<(script|style)\b.*?</\1\s*>|<[^>]*>', re.DOTALL | re.IGNORECASE)
+_WORD_RE = re.compile(r'\w\w+', re.UNICODE)
+
+
+def tokenize(html):
+    """Count the words in the text content of ``html``."""
+    text = unescape(_TEXT_RE.sub(' ', html)).lower()
+    counts = {}
+    for word in _WORD_RE.findall(text):
+        counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+class SearchIndex(object):
+    """Inverted index of pages for client side search.
+
+    Terms are split into shards by their first ``prefix_length``
+    characters.  Every shard maps terms to a list of ``[doc, count]`` pairs
+    where ``doc`` is the position in :attr:`docs`.
+
+    The words of every page are cached in ``cache_file`` along with a hash
+    of its source, so unchanged pages do not need to be rendered again.
+    """
+
+    def __init__(self, cache_file, prefix_length):
+        self.cache_file = cache_file
+        self.prefix_length = prefix_length
+        self.docs = []
+        self.shards = {}
+
+    def _load(self):
+        try:
+            with open(self.cache_file) as fh:
+                return json.load(fh)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, entries):
+        dirname = os.path.dirname(self.cache_file)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp = _tmp_path(self.cache_file)
+        with open(tmp, 'w') as fh:
+            json.dump(entries, fh)
+        os.rename(tmp, self.cache_file)
+
+    def build(self, pages):
+        cached = self._load()
+        entries = {}
+        self.docs = []
+        self.shards = {}
+
+        for page in pages:
+            title = page.meta.get('title', '')
+            key = _hash([title, page.body])
+            entry = cached.get(page.path)
+            _count('search', entry is not None and entry[0] == key)
+            if entry is None or entry[0] != key:
+                counts = tokenize(page.html)
+                for word, count in tokenize(escape(title)).items():
+                    counts[word] = counts.get(word, 0) + count
+                entry = [key, counts]
+            entries[page.path] = entry
+
+            doc = len(self.docs)
+            self.docs.append(page)
+            for term, count in entry[1].items():
+                shard = self.shards.setdefault(term[:self.prefix_length], {})
+                shard.setdefault(term, []).append([doc, count])
+
+        if entries != cached:
+            self._save(entries)
+
+
+def search_index():
+    """Return the :class:`SearchIndex` for the current pages.
+
+    The index is only built again when the pages change.
+    """
+    app = current_app._get_current_object()
+    pages._state()
+    key = (pages._state_key, app)
+    cached = getattr(pages, '_search_cache', None)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    index = SearchIndex(
+        os.path.join(app.config['FLEKKY_CACHE_DIR'], 'search.json'),
+        app.config['FLEKKY_SEARCH_PREFIX'])
+    with _phase('search'):
+        index.build(pages._iter())
+    pages._search_cache = (key, index)
+    return index
+
+
+def _json_response(data):
+    return Response(
+        json.dumps(data, separators=(',', ':'), sort_keys=True),
+        mimetype='application/json')
+
+
+@search_blueprint.route('/search/pages.json')
+def search_pages():
+    _track('iter')
+    return _json_response([
+        [url_for('flekky.page_route', path=page.path),
+         page.meta.get('title', '')]
+        for page in search_index().docs])
+
+
+@search_blueprint.route('/search/terms/<prefix>.json')
+def search_terms(prefix):
+    _track('iter')
+    shard = search_index().shards.get(prefix)
+    if shard is None:
+        abort(404)
+    return _json_response(shard)
+
+
+class TemplateCache(FileSystemBytecodeCache):
+    """Bytecode cache for compiled templates that is kept across builds.
+
+    Jinja stores a checksum of the template source along with the bytecode,
+    so changed templates are compiled again.  If the cache can not be read
+    or written (e.g. in a read-only checkout), templates are simply compiled
+    every time.
+    """
+
+    def load_bytecode(self, bucket):
+        try:
+            super(TemplateCache, self).load_bytecode(bucket)
+        except (IOError, OSError):
+            pass
+
+    def dump_bytecode(self, bucket):
+        try:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    # created concurrently by another worker
+                    if not os.path.isdir(self.directory):
+                        raise
+            super(TemplateCache, self).dump_bytecode(bucket)
+        except (IOError, OSError):
+            pass
 
 
 def create_app(source, settings=None):
@@ -194,67 +1450,1458 @@ def create_app(source, settings=None):
 
     app.config.from_object(__name__)
     app.config['FLATPAGES_ROOT'] = os.path.join(source, 'pages')
+    app.config['FLEKKY_CACHE_DIR'] = os.path.join(source, '_cache')
     app.config.from_object(settings)
 
+    if app.config['FLEKKY_TEMPLATE_CACHE']:
+        directory = os.path.join(app.config['FLEKKY_CACHE_DIR'], 'templates')
+        app.jinja_options = dict(
+            app.jinja_options, bytecode_cache=TemplateCache(directory))
+
+    app.extensions['flekky_images'] = ImageProcessor(
+        app.static_folder,
+        os.path.join(app.config['FLEKKY_CACHE_DIR'], 'images'),
+        app.config['FLEKKY_IMAGE_WIDTHS'],
+        app.config['FLEKKY_IMAGE_QUALITY'])
+
     app.register_blueprint(flekky)
+    if app.config['FLEKKY_SEARCH']:
+        app.register_blueprint(search_blueprint)
     pages.init_app(app)
+    pages.reload()
 
     return app
 
 
+def warm(app):
+    """Fill the caches so that later builds and server restarts are faster.
+
+    All templates are compiled (and stored in the template cache).  If the
+    HTML cache is enabled, all pages are rendered as well.
+
+    Returns the number of templates and pages.
+    """
+    env = app.jinja_env
+    templates = env.list_templates(
+        filter_func=lambda name: not os.path.basename(name).startswith('.'))
+    for name in templates:
+        env.get_template(name)
+
+    rendered = 0
+    if pages.html_cache is not None:
+        for page in pages._pages.values():
+            page.html
+            rendered += 1
+
+    return len(templates), rendered
+
+
+def _setting_state(value):
+    """Convert a setting to data that does not change between processes.
+
+    The repr of functions and most other objects contains their address,
+    so they are described by module and name instead.
+    """
+    if isinstance(value, (list, tuple)):
+        return [_setting_state(v) for v in value]
+    elif isinstance(value, dict):
+        return sorted(
+            (repr(k), _setting_state(v)) for k, v in value.items())
+    elif callable(value):
+        return [getattr(value, '__module__', None),
+                getattr(value, '__qualname__',
+                        getattr(value, '__name__', None))]
+    elif type(value).__repr__ is object.__repr__:
+        cls = type(value)
+        return [cls.__module__, cls.__name__]
+    else:
+        return repr(value)
+
+
+def _page_state(value):
+    """Convert the result of a query on :class:`FlekkyPages` to plain data."""
+    if value is None:
+        return None
+    elif isinstance(value, TaxonomyPage):
+        # must be checked before Page, which it extends
+        return (value.path, repr(value.meta), _page_state(value.items))
+    elif isinstance(value, Page):
+        return (value.path, value._meta, value.body)
+    elif isinstance(value, set):
+        return sorted(repr(v) for v in value)
+    elif isinstance(value, Pagination):
+        return [value.total, _page_state(value.items)]
+    else:
+        return [_page_state(v) for v in value]
+
+
+class BuildCache(object):
+    """Dependency graph of the previous build.
+
+    For every URL rendered by :func:`page_route` we store the dependencies
+    that have been tracked while rendering it (the page itself, the layout
+    and any queries on ``site.pages``) along with a fingerprint of their
+    state.  If none of these fingerprints changed on the next build, the
+    existing output can be reused.
+    """
+
+    def __init__(self, app, pages):
+        self.app = app
+        self.pages = pages
+        shard = app.config.get('FLEKKY_SHARD')
+        if shard is None:
+            filename = 'build.json'
+        else:
+            filename = 'build-%i-of-%i.json' % tuple(shard)
+        self.filename = os.path.join(app.config['FLEKKY_CACHE_DIR'], filename)
+        self.entries = {}
+        self._fingerprints = {}
+
+        app.before_request(self._start)
+        app.after_request(self._record)
+
+    # settings that do not influence the output
+    ignored_settings = [
+        'FLEKKY_TIME',
+        'FLEKKY_INCREMENTAL',
+        'FLEKKY_JOBS',
+        'FLEKKY_PROFILE',
+        'FLEKKY_CACHE_DIR',
+        'FLEKKY_HTML_CACHE',
+        'FLEKKY_HTML_CACHE_SIZE',
+        'FLEKKY_LAZY_PAGES',
+        'FLEKKY_LAZY_PAGES_CACHE',
+        'FLEKKY_TEMPLATE_CACHE',
+        'FLEKKY_COMPRESS',
+        'FLEKKY_COMPRESS_EXTENSIONS',
+        'FLEKKY_SHARD',
+        'FLEKKY_RESPONSE_CACHE',
+    ]
+
+    def _config(self):
+        config = self.app.config
+        return _hash([
+            __version__,
+            config['FREEZER_DESTINATION'],
+            sorted((key, _setting_state(value))
+                   for key, value in config.items()
+                   if key.startswith('FLATPAGES_') or (
+                       key.startswith('FLEKKY_') and
+                       key not in self.ignored_settings)),
+        ])
+
+    def load(self):
+        self.entries = {}
+        self._fingerprints = {}
+        try:
+            with open(self.filename) as fh:
+                data = json.load(fh)
+        except (IOError, ValueError):
+            return
+        if data.get('config') == self._config():
+            self.entries = data['entries']
+
+    def save(self, urls):
+        entries = dict((url, self.entries[url])
+                       for url in urls if url in self.entries)
+        dirname = os.path.dirname(self.filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.filename, 'w') as fh:
+            json.dump({'config': self._config(), 'entries': entries}, fh)
+
+    def _template(self, name):
+        """Fingerprint a template including everything it references."""
+        env = self.app.jinja_env
+        sources = {}
+        todo = [name]
+        while todo:
+            name = todo.pop()
+            if name in sources:
+                continue
+            source = env.loader.get_source(env, name)[0]
+            sources[name] = source
+            for ref in meta.find_referenced_templates(env.parse(source)):
+                if ref is None:
+                    # dynamic reference; we can not know which one it is
+                    todo.extend(env.list_templates())
+                else:
+                    todo.append(ref)
+        return _hash(sorted(sources.items()))
+
+    def fingerprint(self, dependency):
+        key = repr(dependency)
+        if key not in self._fingerprints:
+            kind, args = dependency[0], dependency[1:]
+            if kind == 'template':
+                value = self._template(*args)
+            elif kind == 'static':
+                manifest = self.app.extensions['flekky_static']
+                value = manifest.filename(*args)
+            elif kind == 'image':
+                images = self.app.extensions['flekky_images']
+                value = images.digest(*args)
+            else:
+                query = getattr(self.pages, '_' + kind)
+                value = _hash(_page_state(query(*args)))
+            self._fingerprints[key] = value
+        return self._fingerprints[key]
+
+    def images(self):
+        """List the images that were used by pages in the previous build."""
+        return sorted(set(
+            dependency[1] for entry in self.entries.values()
+            for dependency, fingerprint in entry
+            if dependency[0] == 'image'))
+
+    def is_fresh(self, url, filename):
+        """Check whether the output for ``url`` can be reused.
+
+        This is meant to be used as ``FREEZER_SKIP_EXISTING``.
+        """
+        fresh = self._is_fresh(url)
+        _count('build_cache', fresh)
+        return fresh
+
+    def _is_fresh(self, url):
+        if url not in self.entries:
+            return False
+        for dependency, fingerprint in self.entries[url]:
+            try:
+                if self.fingerprint(dependency) != fingerprint:
+                    return False
+            except TemplateNotFound:
+                return False
+        return True
+
+    def _start(self):
+        g.flekky_dependencies = []
+
+    def _record(self, response):
+        dependencies = getattr(g, 'flekky_dependencies', None)
+        if dependencies and response.status_code == 200:
+            entry = [[list(d), self.fingerprint(d)] for d in dependencies]
+            try:
+                json.dumps(entry)
+            except TypeError:
+                self.entries.pop(request.path, None)
+            else:
+                self.entries[request.path] = entry
+        return response
+
+
+class Profiler(object):
+    """Collect timings per URL and per phase of a build.
+
+    Phases are exclusive: time spent in a nested phase (e.g. ``markdown``
+    inside ``template``) is not attributed to the outer phase.  The
+    ``freezer`` phase covers everything else, i.e. request handling and
+    writing files.
+    """
+
+    def __init__(self):
+        self.urls = {}
+        self._current = None
+        self._stack = []
+
+    def start_url(self, url):
+        self._current = {'phases': {}, 'counters': {}, 'template': None}
+        self.urls[url] = self._current
+
+    def stop_url(self):
+        self._current = None
+
+    def _add(self, name, seconds):
+        if self._current is not None:
+            phases = self._current['phases']
+            phases[name] = phases.get(name, 0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        now = time.time()
+        if self._stack:
+            self._add(self._stack[-1][0], now - self._stack[-1][1])
+        self._stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            name, started = self._stack.pop()
+            self._add(name, now - started)
+            if self._stack:
+                self._stack[-1][1] = now
+
+    def count(self, name, hit):
+        if self._current is not None:
+            counter = self._current['counters'].setdefault(name, [0, 0])
+            counter[0 if hit else 1] += 1
+
+    def set_template(self, template):
+        if self._current is not None:
+            self._current['template'] = template
+
+    def report(self, limit=10):
+        """Aggregate the collected data."""
+        phases = {}
+        templates = {}
+        counters = {}
+        totals = []
+        for url, record in self.urls.items():
+            total = sum(record['phases'].values())
+            totals.append((total, url))
+            for name, seconds in record['phases'].items():
+                phases[name] = phases.get(name, 0) + seconds
+            if record['template'] is not None:
+                template = templates.setdefault(
+                    record['template'], {'count': 0, 'seconds': 0})
+                template['count'] += 1
+                template['seconds'] += total
+            for name, (hits, misses) in record['counters'].items():
+                counter = counters.setdefault(
+                    name, {'hits': 0, 'misses': 0, 'rate': 0})
+                counter['hits'] += hits
+                counter['misses'] += misses
+                counter['rate'] = float(counter['hits']) / (
+                    counter['hits'] + counter['misses'])
+
+        return {
+            'total': sum(phases.values()),
+            'phases': phases,
+            'slowest': [{'url': url, 'seconds': seconds} for seconds, url
+                        in sorted(totals, reverse=True)[:limit]],
+            'templates': templates,
+            'caches': counters,
+            'urls': self.urls,
+        }
+
+    def summary(self, limit=10):
+        """Format the report as a human readable table."""
+        report = self.report(limit)
+        lines = [_('%-30s %10s') % (_('phase'), _('seconds'))]
+        for name, seconds in sorted(
+                report['phases'].items(), key=lambda x: -x[1]):
+            lines.append('%-30s %10.3f' % (name, seconds))
+
+        lines += ['', _('%-50s %10s') % (_('slowest pages'), _('seconds'))]
+        for item in report['slowest']:
+            lines.append('%-50s %10.3f' % (item['url'], item['seconds']))
+
+        lines += ['', _('%-30s %8s %10s') % (
+            _('templates'), _('pages'), _('seconds'))]
+        for name, template in sorted(report['templates'].items(),
+                                     key=lambda x: -x[1]['seconds']):
+            lines.append('%-30s %8i %10.3f' % (
+                name, template['count'], template['seconds']))
+
+        if report['caches']:
+            lines += ['', _('%-30s %8s %8s %8s') % (
+                _('caches'), _('hits'), _('misses'), _('rate'))]
+            for name, counter in sorted(report['caches'].items()):
+                lines.append('%-30s %8i %8i %7.1f%%' % (
+                    name, counter['hits'], counter['misses'],
+                    counter['rate'] * 100))
+
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        with open(filename, 'w') as fh:
+            json.dump(self.report(), fh, indent=2, sort_keys=True)
+
+
+def _matches(path, patterns):
+    """Check ``path`` against fnmatch patterns like Frozen-Flask does.
+
+    Patterns that contain a slash are matched against the whole path,
+    others against its parts.
+    """
+    parts = path.split('/')
+    # a matching directory excludes everything inside it
+    prefixes = ['/'.join(parts[:i + 1]) for i in range(len(parts))]
+    for pattern in patterns:
+        if '/' in pattern:
+            if any(fnmatch(p, pattern.strip('/')) for p in prefixes):
+                return True
+        elif any(fnmatch(part, pattern) for part in parts):
+            return True
+    return False
+
+
+class FlekkyFreezer(Freezer):
+    """Freezer with support for incremental and parallel builds.
+
+    If a ``build_cache`` is given, URLs whose dependencies did not change are
+    skipped.  Stale output is removed by Frozen-Flask
+    (``FREEZER_REMOVE_EXTRA_FILES``).
+
+    If ``FLEKKY_JOBS`` is greater than one, URLs are rendered by a pool of
+    worker processes, each with its own app created from ``factory_args``.
+
+    If ``FLEKKY_PROFILE`` is set, timings are collected in :attr:`profiler`.
+
+    If ``FLEKKY_COMPRESS`` is set, compressed copies of all files are written
+    alongside them.
+
+    Variants of images that are referenced by ``responsive_image`` are
+    encoded in a pool of processes while pages are rendered (see
+    :class:`ImageProcessor`).
+
+    If ``FLEKKY_SHARD`` is set to ``(index, count)``, only the URLs that
+    :func:`url_shard` assigns to this shard are built and a manifest is
+    written to :data:`SHARD_MANIFEST` (see :func:`merge_shards`).  URLs that
+    are not produced by a URL generator but only discovered via ``url_for``
+    are built by every shard that discovers them.
+    """
+
+    def __init__(self, app, build_cache=None, factory_args=None, **kwargs):
+        self.build_cache = build_cache
+        self.factory_args = factory_args
+        self.profiler = Profiler() if app.config['FLEKKY_PROFILE'] else None
+        super(FlekkyFreezer, self).__init__(app, **kwargs)
+
+        self._generated_urls = None
+        self.images = app.extensions['flekky_images']
+
+        self.compressor = None
+        if app.config['FLEKKY_COMPRESS']:
+            self.compressor = Compressor(
+                self.root,
+                os.path.join(app.config['FLEKKY_CACHE_DIR'], 'compress.json'),
+                app.config['FLEKKY_COMPRESS_EXTENSIONS'],
+                app.config['FLEKKY_JOBS'])
+
+    def freeze_yield(self):
+        global _profiler
+
+        if self.build_cache is not None:
+            self.build_cache.load()
+
+        shard = self.app.config['FLEKKY_SHARD']
+        if shard is not None:
+            self._generated_urls = set(
+                url for url, endpoint, last_modified
+                in super(FlekkyFreezer, self)._generate_all_urls())
+        files = {}
+
+        if self.app.config['FLEKKY_JOBS'] > 1:
+            pages = self._parallel_freeze_yield()
+        else:
+            pages = super(FlekkyFreezer, self).freeze_yield()
+
+        if self.compressor is not None:
+            self.compressor.start()
+        if self.app.config['FLEKKY_JOBS'] == 1:
+            # parallel builds already encode images in the render workers
+            self.images.start()
+
+        urls = set()
+        _profiler = self.profiler
+        try:
+            for page in pages:
+                urls.add(page.url)
+                if self.compressor is not None:
+                    self.compressor.add(page.path)
+                if shard is not None:
+                    files[page.path] = _file_hash(
+                        os.path.join(self.root, page.path))
+                yield page
+        except BaseException:
+            if self.compressor is not None:
+                self.compressor.terminate()
+            self.images.terminate()
+            raise
+        finally:
+            _profiler = None
+
+        if self.compressor is not None:
+            self.compressor.finish()
+        self.images.finish()
+
+        manifest = self.app.extensions.get('flekky_static')
+        if manifest is not None:
+            path = os.path.join(
+                self.root, self.app.static_url_path.strip('/'),
+                'manifest.json')
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fh:
+                json.dump(manifest.manifest(), fh, indent=2, sort_keys=True)
+
+        if shard is not None:
+            with open(os.path.join(self.root, SHARD_MANIFEST), 'w') as fh:
+                json.dump({'shard': list(shard), 'files': files}, fh)
+
+        if self.build_cache is not None:
+            self.build_cache.save(urls)
+
+    def _in_shard(self, url):
+        """Check whether ``url`` should be built by this shard."""
+        shard = self.app.config['FLEKKY_SHARD']
+        if shard is None or self._generated_urls is None:
+            return True
+        if url not in self._generated_urls:
+            # only discovered via url_for, so other shards may not know it
+            return True
+        return url_shard(url, shard[1]) == shard[0]
+
+    def _generate_all_urls(self):
+        for url, endpoint, last_modified in super(
+                FlekkyFreezer, self)._generate_all_urls():
+            if self._in_shard(url):
+                yield url, endpoint, last_modified
+
+    def _build_one(self, url, last_modified=None):
+        path = self.urlpath_to_filepath(url)
+        if _matches(path, self.app.config['FREEZER_DESTINATION_IGNORE']):
+            # e.g. an extra file that is linked into the destination
+            raise ValueError(
+                'URL %s would overwrite %s, which is excluded by '
+                'FREEZER_DESTINATION_IGNORE (e.g. an extra file)' % (
+                    url, path))
+
+        # never write through a hard link, which would change the linked
+        # file as well (e.g. an extra file or the output of another build)
+        filename = os.path.join(self.root, *path.split('/'))
+        try:
+            if os.stat(filename).st_nlink > 1:
+                os.unlink(filename)
+        except OSError:
+            pass
+
+        if self.profiler is None:
+            return super(FlekkyFreezer, self)._build_one(url, last_modified)
+
+        self.profiler.start_url(url)
+        try:
+            with self.profiler.phase('freezer'):
+                return super(FlekkyFreezer, self)._build_one(
+                    url, last_modified)
+        finally:
+            self.profiler.stop_url()
+
+    def _check_endpoints(self, seen_endpoints):
+        if self.app.config['FLEKKY_SHARD'] is not None:
+            # some endpoints may not have any URLs in this shard
+            return
+        # feeds and sitemaps are only built if a base URL is set, sitemap
+        # shards only for very large sites and images only if the
+        # responsive_image filter is used
+        seen_endpoints = set(seen_endpoints) | set([
+            'flekky.sitemap', 'flekky.sitemap_shard', 'flekky.atom',
+            'flekky.rss', 'flekky.image_route'])
+        return super(FlekkyFreezer, self)._check_endpoints(seen_endpoints)
+
+    def _parallel_freeze_yield(self):
+        """Like :meth:`freeze_yield`, but distribute the work to processes.
+
+        URLs that are only discovered while rendering (via ``url_for``) are
+        reported back by the workers and built in another round.
+        """
+        jobs = self.app.config['FLEKKY_JOBS']
+        remove_extra = self.app.config['FREEZER_REMOVE_EXTRA_FILES']
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        if remove_extra:
+            ignore = self.app.config['FREEZER_DESTINATION_IGNORE']
+            previous_files = set(
+                normalize('NFC', os.path.join(self.root, *name.split('/')))
+                for name in walk_directory(self.root, ignore=ignore))
+        seen_urls = set()
+        seen_endpoints = set()
+        built_files = set()
+
+        todo = []
+        for url, endpoint, last_modified in self._generate_all_urls():
+            seen_endpoints.add(endpoint)
+            if url not in seen_urls:
+                seen_urls.add(url)
+                todo.append(url)
+
+        args, kwargs = self.factory_args or ((), {})
+        pool = multiprocessing.Pool(jobs, _init_worker, (
+            args, kwargs, self.app.config['FLEKKY_TIME']))
+        try:
+            while todo:
+                chunksize = max(1, len(todo) // (jobs * 4))
+                results = pool.imap_unordered(_freeze_url, todo, chunksize)
+                todo = []
+                for url, filename, discovered, entry, record in results:
+                    built_files.add(normalize('NFC', filename))
+                    if record is not None and self.profiler is not None:
+                        self.profiler.urls[url] = record
+                    if entry is not None and self.build_cache is not None:
+                        self.build_cache.entries[url] = entry
+                    for _url, endpoint in discovered:
+                        seen_endpoints.add(endpoint)
+                        if _url not in seen_urls and self._in_shard(_url):
+                            seen_urls.add(_url)
+                            todo.append(_url)
+                    yield FrozenPage(url, os.path.relpath(filename, self.root))
+        finally:
+            pool.close()
+            pool.join()
+
+        self._check_endpoints(seen_endpoints)
+        if remove_extra:
+            for extra_file in previous_files - built_files:
+                os.remove(extra_file)
+                parent = os.path.dirname(extra_file)
+                if not os.listdir(parent):
+                    os.removedirs(parent)
+
+
+def compress_formats():
+    """Return the supported compression formats.
+
+    Brotli is only used if the `brotli` package is installed.
+    """
+    try:
+        import brotli  # noqa
+    except ImportError:
+        return ['gz']
+    return ['gz', 'br']
+
+
+def compress_file(filename, previous, formats):
+    """Write compressed siblings (e.g. ``index.html.gz``) of ``filename``.
+
+    Nothing is written if the hash of the content is equal to ``previous``
+    and all siblings exist.
+
+    Returns the hash of the content.
+    """
+    with open(filename, 'rb') as fh:
+        content = fh.read()
+    digest = hashlib.sha1(content).hexdigest()
+
+    for fmt in formats:
+        path = '%s.%s' % (filename, fmt)
+        if digest == previous and os.path.exists(path):
+            continue
+        if fmt == 'gz':
+            # fixed mtime so that unchanged content results in the same file
+            with open(path, 'wb') as fh:
+                with gzip.GzipFile('', 'wb', 9, fh, mtime=0) as gz:
+                    gz.write(content)
+        elif fmt == 'br':
+            import brotli
+            with open(path, 'wb') as fh:
+                fh.write(brotli.compress(content))
+        else:
+            raise ValueError('invalid format: %s' % fmt)
+
+    return digest
+
+
+class Compressor(object):
+    """Write precompressed copies of files as they are frozen.
+
+    Files are compressed in a pool of processes while the build is still
+    running.  The content hash of each file is stored in ``manifest`` so that
+    unchanged files are skipped on the next build.  Compressed copies of
+    files that are no longer part of the build are removed.
+    """
+
+    def __init__(self, root, manifest, extensions, jobs=None):
+        self.root = root
+        self.manifest = manifest
+        self.extensions = tuple(extensions)
+        self.formats = compress_formats()
+        self.jobs = jobs
+        self.pool = None
+        self.previous = {}
+        self.results = {}
+
+    def start(self):
+        try:
+            with open(self.manifest) as fh:
+                data = json.load(fh)
+        except (IOError, ValueError):
+            data = {}
+        if data.get('formats') == self.formats:
+            self.previous = data['files']
+        self.results = {}
+        self.pool = multiprocessing.Pool(self.jobs)
+
+    def add(self, path):
+        """Compress ``path`` (relative to :attr:`root`) in the background."""
+        if path in self.results or not path.endswith(self.extensions):
+            return
+        self.results[path] = self.pool.apply_async(compress_file, (
+            os.path.join(self.root, path),
+            self.previous.get(path),
+            self.formats))
+
+    def finish(self):
+        self.pool.close()
+        try:
+            files = dict((path, result.get())
+                         for path, result in self.results.items())
+        finally:
+            self.pool.join()
+            self.pool = None
+
+        for path in set(self.previous) - set(files):
+            for fmt in self.formats:
+                sibling = os.path.join(self.root, '%s.%s' % (path, fmt))
+                if os.path.exists(sibling):
+                    os.remove(sibling)
+                    parent = os.path.dirname(sibling)
+                    if not os.listdir(parent):
+                        os.removedirs(parent)
+
+        dirname = os.path.dirname(self.manifest)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.manifest, 'w') as fh:
+            json.dump({'formats': self.formats, 'files': files}, fh)
+        return files
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+class StaticManifest(object):
+    """Content hashes of the files in the static folder.
+
+    The hashes are cached in ``cache_file`` along with size and mtime of each
+    file so that unchanged files are not read again.
+    """
+
+    def __init__(self, directory, cache_file):
+        self.directory = directory
+        self.cache_file = cache_file
+        self.entries = {}
+        self._changed = False
+
+    def load(self):
+        try:
+            with open(self.cache_file) as fh:
+                cached = json.load(fh)
+        except (IOError, ValueError):
+            cached = {}
+
+        self.entries = {}
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, self.directory)
+                name = name.replace(os.sep, '/')
+                stat = os.stat(path)
+                entry = cached.get(name)
+                if entry is None or entry[:2] != [stat.st_size, stat.st_mtime]:
+                    with open(path, 'rb') as fh:
+                        digest = hashlib.sha1(fh.read()).hexdigest()
+                    entry = [stat.st_size, stat.st_mtime, digest]
+                self.entries[name] = entry
+        self._changed = self.entries != cached
+
+    def save(self):
+        if not self._changed:
+            return
+        dirname = os.path.dirname(self.cache_file)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(self.cache_file, 'w') as fh:
+            json.dump(self.entries, fh)
+        self._changed = False
+
+    def filename(self, name):
+        """Return the fingerprinted filename, e.g. ``style.1a2b3c4d5e.css``."""
+        entry = self.entries.get(name)
+        if entry is None:
+            return name
+        root, ext = os.path.splitext(name)
+        return '%s.%s%s' % (root, entry[2][:10], ext)
+
+    def manifest(self):
+        """Map the original filenames to the fingerprinted ones."""
+        return dict((name, self.filename(name)) for name in self.entries)
+
+
+def fingerprint_static(app):
+    """Make ``url_for('static')`` use fingerprinted filenames.
+
+    The static view is replaced by one that serves the original files under
+    their fingerprinted names.
+    """
+    manifest = StaticManifest(
+        app.static_folder,
+        os.path.join(app.config['FLEKKY_CACHE_DIR'], 'static.json'))
+    manifest.load()
+    manifest.save()
+    original = dict((v, k) for k, v in manifest.manifest().items())
+
+    @app.url_defaults
+    def static_url_defaults(endpoint, values):
+        if endpoint == 'static' and 'filename' in values:
+            _track('static', values['filename'])
+            values['filename'] = manifest.filename(values['filename'])
+
+    def static(filename):
+        return app.send_static_file(original.get(filename, filename))
+
+    app.view_functions['static'] = static
+    app.extensions['flekky_static'] = manifest
+    return manifest
+
+
+class Minifier(object):
+    """Minify HTML and CSS responses before they are written.
+
+    Results are cached on disk by the hash of the original content.
+    """
+
+    minifiers = {
+        'text/html': minify_html,
+        'text/css': minify_css,
+    }
+
+    def __init__(self, directory, max_size):
+        self.cache = HtmlCache(directory, max_size)
+
+    def minify(self, mimetype, content):
+        key = '%s-%s' % (
+            mimetype.replace('/', '-'),
+            hashlib.sha1(content.encode('utf-8')).hexdigest())
+        result = self.cache.get(key)
+        _count('minify', result is not None)
+        if result is None:
+            with _phase('minify'):
+                result = self.minifiers[mimetype](content)
+            self.cache.set(key, result)
+        return result
+
+    def __call__(self, response):
+        if (response.status_code != 200 or
+                response.mimetype not in self.minifiers):
+            return response
+        # static files are usually passed through as a file
+        response.direct_passthrough = False
+        content = response.get_data(as_text=True)
+        response.set_data(self.minify(response.mimetype, content))
+        return response
+
+
+IMAGE_FORMATS = {
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.png': 'png',
+    '.webp': 'webp',
+}
+
+
+def image_formats():
+    """Return the additional formats that images are converted to.
+
+    Images can only be resized if `Pillow` is installed (``None`` is returned
+    otherwise).  WebP is only used if Pillow supports it.
+    """
+    try:
+        from PIL import features
+    except ImportError:
+        return None
+    if features.check('webp'):
+        return ['webp']
+    return []
+
+
+def resize_image(source, dest, width, fmt, quality):
+    """Write a copy of ``source`` that is ``width`` pixels wide to ``dest``.
+
+    Images are never scaled up.
+    """
+    from PIL import Image
+
+    image = Image.open(source)
+    if image.size[0] > width:
+        height = max(1, int(round(image.size[1] * width / image.size[0])))
+        image = image.resize((width, height), Image.LANCZOS)
+    if fmt == 'jpeg' and image.mode not in ['RGB', 'L']:
+        image = image.convert('RGB')
+
+    dirname = os.path.dirname(dest)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # created concurrently by another worker
+            if not os.path.isdir(dirname):
+                raise
+    tmp = _tmp_path(dest)
+    image.save(tmp, fmt.upper(), quality=quality, optimize=True)
+    os.rename(tmp, dest)
+    return dest
+
+
+class ImageProcessor(object):
+    """Resized and re-encoded variants of images in the static folder.
+
+    Variants are stored in ``directory`` under a hash of the content of the
+    source image and the parameters, so images are only encoded again if
+    they changed.  Hash and dimensions of every source image are cached in
+    ``directory/images.json`` along with size and mtime of the file.
+
+    Variants are encoded when they are requested.  After :meth:`start` they
+    are also queued in a pool of processes as soon as they are referenced,
+    so encoding happens in the background while pages are rendered.
+    """
+
+    def __init__(self, static_folder, directory, widths, quality):
+        self.static_folder = static_folder
+        self.directory = directory
+        self.widths = sorted(widths)
+        self.quality = quality
+        self.cache_file = os.path.join(directory, 'images.json')
+        self.formats = None
+        self.pool = None
+        self.results = {}
+        self._jobs = None
+        self._sources = None
+        self._changed = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        self.formats = image_formats()
+        try:
+            with open(self.cache_file) as fh:
+                self._sources = json.load(fh)
+        except (IOError, ValueError):
+            self._sources = {}
+
+    def save(self):
+        with self._lock:
+            if not self._changed:
+                return
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(self.cache_file, 'w') as fh:
+                json.dump(self._sources, fh)
+            self._changed = False
+
+    def source(self, filename):
+        """Return size, mtime, hash, width and height of a source image.
+
+        ``None`` is returned if ``filename`` does not exist in the static
+        folder or can not be processed.
+        """
+        name = os.path.normpath(filename)
+        if (os.path.isabs(name) or name.startswith(os.pardir) or
+                os.path.splitext(name)[1].lower() not in IMAGE_FORMATS):
+            return None
+        path = os.path.join(self.static_folder, name)
+
+        with self._lock:
+            if self._sources is None:
+                self._load()
+            if self.formats is None:
+                return None
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            entry = self._sources.get(name)
+            if entry is None or entry[:2] != [stat.st_size, stat.st_mtime]:
+                from PIL import Image
+                with open(path, 'rb') as fh:
+                    digest = hashlib.sha1(fh.read()).hexdigest()
+                try:
+                    size = Image.open(path).size
+                except IOError:
+                    return None
+                entry = [stat.st_size, stat.st_mtime, digest] + list(size)
+                self._sources[name] = entry
+                self._changed = True
+            return entry
+
+    def digest(self, filename):
+        """Return the content hash of a source image."""
+        entry = self.source(filename)
+        return entry and entry[2]
+
+    def variants(self, filename):
+        """List ``(width, format)`` of all variants of an image.
+
+        Widths are taken from ``FLEKKY_IMAGE_WIDTHS`` up to the width of the
+        original.  Every width is available in the format of the original
+        and in all additional formats (e.g. WebP).
+        """
+        entry = self.source(filename)
+        if entry is None:
+            return []
+        width = entry[3]
+        widths = [w for w in self.widths if w < width] + [width]
+        fmt = IMAGE_FORMATS[os.path.splitext(filename)[1].lower()]
+        formats = [f for f in self.formats if f != fmt] + [fmt]
+        return [(w, f) for f in formats for w in widths]
+
+    def path(self, filename, width, fmt):
+        """Return the location of a variant in the cache."""
+        key = _hash([self.digest(filename), width, fmt, self.quality])
+        return os.path.join(self.directory, key[:2], '%s.%s' % (key, fmt))
+
+    def add(self, filename, width, fmt):
+        """Encode a variant in the background (only after :meth:`start`)."""
+        if self._jobs is None:
+            return
+        path = self.path(filename, width, fmt)
+        if path in self.results or os.path.exists(path):
+            return
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self._jobs)
+        self.results[path] = self.pool.apply_async(resize_image, (
+            os.path.join(self.static_folder, filename),
+            path, width, fmt, self.quality))
+
+    def get(self, filename, width, fmt):
+        """Return the location of a variant and encode it if necessary."""
+        path = self.path(filename, width, fmt)
+        result = self.results.pop(path, None)
+        if result is not None:
+            _count('images', False)
+            with _phase('images'):
+                result.get()
+        elif os.path.exists(path):
+            _count('images', True)
+        else:
+            _count('images', False)
+            with _phase('images'):
+                resize_image(os.path.join(self.static_folder, filename),
+                             path, width, fmt, self.quality)
+        return path
+
+    def start(self, jobs=None):
+        """Use a pool of ``jobs`` processes (default: one per CPU)."""
+        self._jobs = jobs or multiprocessing.cpu_count()
+
+    def finish(self):
+        self._jobs = None
+        if self.pool is not None:
+            self.pool.close()
+            try:
+                for result in self.results.values():
+                    result.get()
+            finally:
+                self.pool.join()
+                self.pool = None
+                self.results = {}
+        self.save()
+
+    def terminate(self):
+        self._jobs = None
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.results = {}
+
+
+SHARD_MANIFEST = '.flekky-shard.json'
+
+
+def url_shard(url, count):
+    """Deterministically assign ``url`` to one of ``count`` shards.
+
+    Shards are numbered from 1 to ``count``.
+    """
+    digest = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % count + 1
+
+
+def _file_hash(path):
+    with open(path, 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+
+def merge_shards(shards, destination):
+    """Combine the output of sharded builds into ``destination``.
+
+    All shards of a build must be given.  Files that exist in more than one
+    shard must be identical, otherwise they are reported as conflicts and
+    nothing is written.  Files are hard linked where possible and files in
+    ``destination`` that are not part of any shard are removed.
+
+    Returns a sorted list of conflicting files (relative paths).
+    """
+    count = None
+    indexes = []
+    for shard in shards:
+        try:
+            with open(os.path.join(shard, SHARD_MANIFEST)) as fh:
+                manifest = json.load(fh)
+        except (IOError, ValueError):
+            raise ValueError('not the output of a sharded build: %s' % shard)
+        index, shard_count = manifest['shard']
+        if count is not None and shard_count != count:
+            raise ValueError('shards from different builds: %s' % shard)
+        count = shard_count
+        indexes.append(index)
+
+        for relpath, digest in manifest['files'].items():
+            path = os.path.join(shard, relpath)
+            if not os.path.exists(path) or _file_hash(path) != digest:
+                raise ValueError('modified after the build: %s' % path)
+    if sorted(indexes) != list(range(1, (count or 0) + 1)):
+        raise ValueError('missing or duplicate shards: %s' % ', '.join(
+            '%i/%i' % (index, count) for index in sorted(indexes)))
+
+    files = {}
+    conflicts = set()
+    for shard in shards:
+        for dirpath, dirnames, filenames in os.walk(shard):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                relpath = os.path.relpath(path, shard)
+                if relpath == SHARD_MANIFEST:
+                    continue
+                digest = _file_hash(path)
+                if relpath not in files:
+                    files[relpath] = (digest, path)
+                elif files[relpath][0] != digest:
+                    conflicts.add(relpath)
+    if conflicts:
+        return sorted(conflicts)
+
+    if os.path.isdir(destination):
+        for dirpath, dirnames, filenames in os.walk(destination):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if os.path.relpath(path, destination) not in files:
+                    os.unlink(path)
+    for relpath, (digest, path) in files.items():
+        dest = os.path.join(destination, relpath)
+        dirname = os.path.dirname(dest)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        link(path, dest)
+    return []
+
+
+_worker_freezer = None
+
+
+def _init_worker(args, kwargs, build_time):
+    global _worker_freezer, _profiler
+    _worker_freezer = create_freezer(*args, **kwargs)
+    # all workers must use the same build time
+    _worker_freezer.app.config['FLEKKY_TIME'] = build_time
+    _profiler = _worker_freezer.profiler
+    # only report URLs that are discovered via url_for
+    _worker_freezer.url_generators = []
+    if _worker_freezer.build_cache is not None:
+        _worker_freezer.build_cache.load()
+
+
+def _freeze_url(url):
+    """Build a single URL in a worker process."""
+    freezer = _worker_freezer
+    filename = freezer._build_one(url)
+    discovered = [(_url, endpoint) for _url, endpoint, last_modified
+                  in freezer._generate_all_urls()]
+    entry = None
+    if freezer.build_cache is not None:
+        entry = freezer.build_cache.entries.get(url)
+    record = None
+    if freezer.profiler is not None:
+        record = freezer.profiler.urls.get(url)
+    return url, filename, discovered, entry, record
+
+
 def create_freezer(*args, **kwargs):
     """Freezer factory.
 
     Any arguments will be forwarded to the underlying app factory.
     """
     def urls():
-        yield '.page_route', {'path': '/'}
+        yield 'flekky.page_route', {'path': '/'}
+        if base_url():
+            yield 'flekky.sitemap', {}
+            yield 'flekky.atom', {}
+            yield 'flekky.rss', {}
+            for number in range(1, sitemap_shards() + 1):
+                yield 'flekky.sitemap_shard', {'number': number}
+        if app.config['FLEKKY_SEARCH']:
+            yield 'search.search_pages', {}
+            for prefix in sorted(search_index().shards):
+                yield 'search.search_terms', {'prefix': prefix}
         for page in pages:
-            yield '.page_route', {'path': page.path}
-
-    freezer = Freezer(create_app(*args, **kwargs))
+            yield 'flekky.page_route', {'path': page.path}
+        for page in pages.virtual_pages():
+            yield 'flekky.page_route', {'path': page.path}
+        if build_cache is not None:
+            # pages that are skipped do not report the images they use
+            images = app.extensions['flekky_images']
+            for filename in build_cache.images():
+                for width, fmt in images.variants(filename):
+                    yield 'flekky.image_route', {
+                        'filename': filename, 'width': width, 'fmt': fmt}
+
+        index = pages.get('index')
+        extra = [index] if index else []
+        for page in extra + list(pages) + pages.virtual_pages():
+            pagination = pages.paginate_page(page)
+            if pagination is not None:
+                for number in range(2, pagination.pages + 1):
+                    yield 'flekky.page_route', {
+                        'path': page.path, 'number': number}
+
+    app = create_app(*args, **kwargs)
+    if app.config['FLEKKY_TIME'] is None:
+        app.config['FLEKKY_TIME'] = datetime.now()
+
+    if app.config['FLEKKY_FINGERPRINT']:
+        fingerprint_static(app)
+
+    if app.config['FLEKKY_MINIFY']:
+        app.after_request(Minifier(
+            os.path.join(app.config['FLEKKY_CACHE_DIR'], 'minify'),
+            app.config['FLEKKY_HTML_CACHE_SIZE']))
+
+    if app.config['FLEKKY_COMPRESS']:
+        # compressed files are managed by Compressor
+        app.config['FREEZER_DESTINATION_IGNORE'] = list(
+            app.config.get('FREEZER_DESTINATION_IGNORE', [])) + [
+                '*.%s' % fmt for fmt in compress_formats()]
+
+    build_cache = None
+    if app.config['FLEKKY_INCREMENTAL']:
+        build_cache = BuildCache(app, pages)
+        app.config['FREEZER_SKIP_EXISTING'] = build_cache.is_fresh
+
+    # routes without arguments (e.g. feeds) are only built if they are
+    # available, so they are yielded by urls()
+    freezer = FlekkyFreezer(
+        app, build_cache=build_cache, factory_args=(args, kwargs),
+        with_no_argument_rules=False)
     freezer.register_generator(urls)
     return freezer
 
 
-def parse_args(argv=None):
-    """Parse command line arguments.
+class Watcher(object):
+    """Watch directories and call ``callback`` with a list of changed files.
 
-    Args:
-        argv (list): List of command line parameters.
-    """
-    parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument(
-        '--version', '-V', action='version', version=__version__)
-    parser.add_argument(
-        '--source', '-s', default='_source',
-        help=_('directory where Flekky will read files (default: _source)'))
-    parser.add_argument(
-        '--future', action='store_true', dest='FLEKKY_FUTURE',
-        help=_('include pages with dates in the future (default: false)'))
-    parser.add_argument(
-        '--unpublished', action='store_true', dest='FLEKKY_UNPUBLISHED',
-        help=_('include unpublished pages (default: false)'))
-    subparsers = parser.add_subparsers(title=_('commands'))
-
-    parser_build = subparsers.add_parser(
-        'build', help=_('generate static sites'))
-    parser_build.add_argument(
-        '--destination', '-d', default=None,
-        help=_('directory where Flekky will write files '
-               '(default: <source>_build)'))
-    parser_build.set_defaults(cmd='build')
-
-    parser_serve = subparsers.add_parser(
-        'serve', help=_('run a test server for development'))
-    parser_serve.add_argument('--port', '-p', type=int, default=8000)
-    parser_serve.set_defaults(cmd='serve')
-
-    parser_build = subparsers.add_parser(
-        'init', help=_('bootstrap a new project'))
-    parser_build.set_defaults(cmd='init')
-
-    return parser.parse_args(argv)
+    Uses watchdog (inotify and friends) if it is installed and falls back to
+    polling otherwise.
+    """
+
+    def __init__(self, directories, callback, interval=1):
+        self.directories = [d for d in directories if os.path.isdir(d)]
+        self.callback = callback
+        self.interval = interval
+        self._snapshot = {}
+
+    def start(self):
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            self._snapshot = self._scan()
+            thread = threading.Thread(target=self._poll)
+            thread.daemon = True
+            thread.start()
+            return
+
+        callback = self.callback
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                # directories are modified whenever a file in them is
+                # created, deleted or renamed, which is reported separately
+                if event.is_directory and event.event_type in [
+                        'created', 'modified']:
+                    return
+                paths = [event.src_path, getattr(event, 'dest_path', None)]
+                callback([path for path in paths if path])
+
+        observer = Observer()
+        for directory in self.directories:
+            observer.schedule(Handler(), directory, recursive=True)
+        observer.daemon = True
+        observer.start()
+
+    def _scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_mtime, stat.st_size)
+        return snapshot
+
+    def check(self):
+        """Compare the current state to the last one and report changes."""
+        snapshot = self._scan()
+        changed = [path for path in set(snapshot) | set(self._snapshot)
+                   if snapshot.get(path) != self._snapshot.get(path)]
+        self._snapshot = snapshot
+        if changed:
+            self.callback(sorted(changed))
+
+    def _poll(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+
+class LiveReload(object):
+    """Tell connected browsers to reload using server-sent events."""
+
+    script = ('<script>new EventSource("/_flekky/events").onmessage = '
+              'function() { location.reload(); };</script>')
+
+    def __init__(self, timeout=15):
+        self.generation = 0
+        self.timeout = timeout
+        self._condition = threading.Condition()
+
+    def notify(self):
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def events(self):
+        generation = self.generation
+        while True:
+            with self._condition:
+                if self.generation == generation:
+                    self._condition.wait(self.timeout)
+                current = self.generation
+            if current != generation:
+                generation = current
+                yield 'data: reload\n\n'
+            else:
+                yield ': ping\n\n'
+
+    def inject(self, response):
+        if response.mimetype == 'text/html' and not response.is_streamed:
+            html = response.get_data(as_text=True)
+            i = html.rfind('</body>')
+            if i != -1:
+                response.set_data(html[:i] + self.script + html[i:])
+        return response
+
+
+class ResponseCache(object):
+    """Cache rendered responses until something changes.
+
+    Responses are stored by URL and the generation of :class:`LiveReload`,
+    so all entries are invalidated as soon as the watcher reports a change
+    to a page, template or static file.  Strong ETags are added so that
+    browsers can revalidate with a cheap ``304 Not Modified``.
+
+    Responses are only stored for renders that saw a complete state of the
+    pages, because :class:`FlekkyPages` publishes a rebuilt state only once
+    it is complete.
+    """
+
+    def __init__(self, live_reload, maxsize):
+        self.live_reload = live_reload
+        self._cache = LRUCache(maxsize)
+        self._lock = threading.Lock()
+
+    def lookup(self):
+        """Return a cached response (used with ``before_request``)."""
+        if request.method != 'GET':
+            return None
+        key = (self.live_reload.generation, request.full_path)
+        g.flekky_cache_key = key
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry is not None:
+            g.flekky_cache_hit = True
+            status, headers, body = entry
+            return Response(body, status=status, headers=headers)
+
+    def store(self, response):
+        """Store and revalidate responses (used with ``after_request``)."""
+        key = g.pop('flekky_cache_key', None)
+        if key is None:
+            return response
+        if not g.pop('flekky_cache_hit', False):
+            if (response.status_code != 200 or response.is_streamed or
+                    response.direct_passthrough):
+                return response
+            body = response.get_data()
+            response.set_etag(hashlib.sha1(body).hexdigest())
+            with self._lock:
+                self._cache.set(key, (
+                    response.status_code, list(response.headers), body))
+        return response.make_conditional(request)
+
+
+def watch(app, source):
+    """Prepare ``app`` to update pages and reload browsers on changes.
+
+    This replaces ``FLATPAGES_AUTO_RELOAD``, which reloads all pages on
+    every request.  Unless ``FLEKKY_RESPONSE_CACHE`` is 0, responses are
+    cached until the next change (see :class:`ResponseCache`).  The
+    returned watcher still has to be started.
+    """
+    live_reload = LiveReload()
+
+    def on_change(filenames):
+        pages.update(filenames)
+        live_reload.notify()
+
+    app.config['FLATPAGES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = True
+    app.add_url_rule(
+        '/_flekky/events', 'flekky_events',
+        lambda: Response(live_reload.events(), mimetype='text/event-stream'))
+    app.after_request(live_reload.inject)
+
+    if app.config['FLEKKY_RESPONSE_CACHE']:
+        cache = ResponseCache(live_reload, app.config['FLEKKY_RESPONSE_CACHE'])
+        app.before_request(cache.lookup)
+        # after_request functions are called in reverse order, so responses
+        # are stored before the live reload script is injected
+        app.after_request(cache.store)
+
+    directories = [os.path.join(source, d)
+                   for d in ['pages', 'static', 'templates']]
+    return Watcher(directories, on_change), live_reload
+
+
+def copy_file(src, dest):
+    """Copy a file including its metadata.
+
+    Uses ``os.copy_file_range`` where available so that filesystems that
+    support it can share data between the files (reflinks).
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is None:
+        shutil.copy2(src, dest)
+        return
+
+    with open(src, 'rb') as fsrc, open(dest, 'wb') as fdest:
+        try:
+            while copy_file_range(fsrc.fileno(), fdest.fileno(), 1 << 30):
+                pass
+        except OSError:
+            fsrc.seek(0)
+            fdest.seek(0)
+            fdest.truncate()
+            shutil.copyfileobj(fsrc, fdest)
+    shutil.copystat(src, dest)
+
+
+def link(src, dest):
+    """Create a hard link or a copy if that is not possible."""
+    try:
+        os.link(src, dest)
+    except OSError as err:
+        if err.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK,
+                             errno.ENOTSUP]:
+            raise
+        copy_file(src, dest)
 
 
 def rlink(src, dest):
@@ -267,40 +2914,98 @@ def rlink(src, dest):
         if (not os.path.exists(dest) or
                 os.path.getmtime(dest) < os.path.getmtime(src)):
             os.unlink(dest)
-            os.link(src, dest)
+            link(src, dest)
     else:
-        os.link(src, dest)
+        link(src, dest)
 
 
-def main():  # pragma: no cover
-    args = parse_args()
-    source = os.path.abspath(args.source)
-
-    if args.cmd == 'build':
-        if args.destination is None:
-            args.destination = '%s_build' % args.source
-        destination = os.path.abspath(args.destination)
-        args.FREEZER_DESTINATION = destination
-        freezer = create_freezer(source, args)
-        freezer.freeze()
-
-        # copy all additional files
-        for filename in os.listdir(source):
-            if (filename not in ['pages', 'static', 'templates'] and
-                    not filename.startswith('_') and
-                    not filename.startswith('.')):
-                srcpath = os.path.join(source, filename)
-                dstpath = os.path.join(destination, filename)
-                rlink(srcpath, dstpath)
-    elif args.cmd == 'serve':
-        app = create_app(source, args)
-        app.run(port=args.port)
-    elif args.cmd == 'init':
-        init = resource_filename(__name__, 'init')
-        shutil.copytree(init, source)
-        print(_('Created new project in %s.') % source)
-    else:
-        raise ValueError('invalid command: %s' % args.cmd)
+def extra_files(source):
+    """List the top level files in ``source`` that are copied verbatim."""
+    return sorted(
+        filename for filename in os.listdir(source)
+        if (filename not in ['pages', 'static', 'templates'] and
+            not filename.startswith('_') and
+            not filename.startswith('.')))
+
+
+def sync_extra_files(source, destination, manifest, threads=8):
+    """Link or copy all extra files from ``source`` to ``destination``.
+
+    Size and mtime of every source file are stored in the JSON file
+    ``manifest``.  Files that did not change since the last sync are
+    skipped and files that no longer exist in ``source`` are removed from
+    ``destination``.  Files are linked in a pool of threads.
+
+    Returns the number of linked and removed files.
+    """
+    try:
+        with open(manifest) as fh:
+            data = json.load(fh)
+    except (IOError, ValueError):
+        data = {}
+    if data.get('destination') != destination:
+        data = {'destination': destination, 'files': {}}
+    previous = data['files']
+
+    files = {}
+    todo = []
+    for name in extra_files(source):
+        srcpath = os.path.join(source, name)
+        if os.path.isdir(srcpath):
+            paths = []
+            for dirpath, dirnames, filenames in os.walk(srcpath):
+                dirname = os.path.join(
+                    destination, os.path.relpath(dirpath, source))
+                if not os.path.isdir(dirname):
+                    if os.path.lexists(dirname):
+                        os.unlink(dirname)
+                    os.makedirs(dirname)
+                paths += [os.path.join(dirpath, f) for f in filenames]
+        else:
+            paths = [srcpath]
+
+        for path in paths:
+            relpath = os.path.relpath(path, source)
+            stat = os.stat(path)
+            files[relpath] = [stat.st_size, stat.st_mtime]
+            dest = os.path.join(destination, relpath)
+            if previous.get(relpath) != files[relpath] or (
+                    not os.path.lexists(dest)):
+                todo.append((path, dest))
+
+    def _sync(paths):
+        src, dest = paths
+        if os.path.lexists(dest):
+            os.unlink(dest)
+        link(src, dest)
+
+    if todo:
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            pool.map(_sync, todo)
+        finally:
+            pool.close()
+            pool.join()
+
+    removed = 0
+    for relpath in set(previous) - set(files):
+        dest = os.path.join(destination, relpath)
+        if os.path.lexists(dest) and not os.path.isdir(dest):
+            os.unlink(dest)
+            removed += 1
+            parent = os.path.dirname(dest)
+            while parent != destination and not os.listdir(parent):
+                os.rmdir(parent)
+                parent = os.path.dirname(parent)
+
+    dirname = os.path.dirname(manifest)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    data['files'] = files
+    with open(manifest, 'w') as fh:
+        json.dump(data, fh)
+
+    return len(todo), removed
 
 
 if __name__ == '__main__':  # pragma: no cover
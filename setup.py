@@ -8,7 +8,7 @@ DIRNAME = os.path.abspath(os.path.dirname(__file__))
 rel = lambda *parts: os.path.abspath(os.path.join(DIRNAME, *parts))
 
 README = open(rel('README.rst')).read()
-FLEKKY = open(rel('flekky', 'flekky.py')).read()
+FLEKKY = open(rel('flekky', '__init__.py')).read()
 VERSION = re.search("__version__ = '([^']+)'", FLEKKY).group(1)
 
 
@@ -24,7 +24,6 @@ setup(
         'Flask>=0.10.1',
         'Flask-FlatPages>=0.6',
         'Frozen-Flask>=0.11',
-        'beautifulsoup4>=4.4.0',
         'argparse>=1.2.1',
     ],
     test_suite='test',
@@ -37,7 +36,7 @@ setup(
         'init/templates/layout/default.html',
     ]},
     license='GPLv3+',
-    entry_points={'console_scripts': 'flekky=flekky.flekky:main'},
+    entry_points={'console_scripts': 'flekky=flekky.cli:main'},
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Environment :: Console',
@@ -1,14 +1,27 @@
 import sys
 import os
+import errno
+import gzip
+import json
 from random import randint
-from shutil import rmtree
+from shutil import copytree, ignore_patterns, rmtree
 from time import sleep
 import locale
+import re
+import subprocess
+import threading
+import warnings
 
 from datetime import datetime
 from flask import Markup
+from flask_frozen import MissingURLGeneratorWarning
 from werkzeug.exceptions import NotFound
 
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 import unittest
 
 root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -18,6 +31,10 @@ locale.setlocale(locale.LC_ALL, 'C')
 
 from flekky import flekky  # noqa
 
+# do not write compiled templates to _example/_cache
+# (enabled again in TestTemplateCache)
+flekky.FLEKKY_TEMPLATE_CACHE = False
+
 if sys.version_info[0] < 3:
     from StringIO import StringIO
     _str = unicode  # noqa
@@ -65,6 +82,77 @@ class TestFlekkyPages(TestCase):
         paths = set([p.path for p in by_category])
         self.assertSetEqual(paths, set(['test']))
 
+    def test_by_key_default(self):
+        by_layout = self.pages.by_key('layout', 'default', default='default')
+        paths = [p.path for p in by_layout]
+        self.assertEqual(paths, [p.path for p in self.pages
+                                 if 'layout' not in p.meta])
+
+    def test_by_key_unhashable(self):
+        self.assertEqual(list(self.pages.by_key('tags', ['test'])), [])
+
+    def test_index_invalidation(self):
+        self.assertSetEqual(self.pages.values('title'), set([
+            'Lorem Ipsum', 'Hello World', 'test', 'example', 'greeting']))
+        self.app.config['FLEKKY_UNPUBLISHED'] = True
+        self.assertIn('This is a draft', self.pages.values('title'))
+
+    def test_reload(self):
+        list(self.pages)
+        generation = self.pages._generation
+        self.pages.reload()
+        list(self.pages)
+        self.assertEqual(self.pages._generation, generation)
+        self.pages._file_cache.clear()
+        self.pages.reload()
+        list(self.pages)
+        self.assertGreater(self.pages._generation, generation)
+
+    def test_get_config_change(self):
+        self.assertIsNotNone(self.pages.get('index'))
+        self.assertIsNone(self.pages.get('future'))
+        self.app.config['FLEKKY_FUTURE'] = True
+        self.assertIsNotNone(self.pages.get('future'))
+
+    def test_len(self):
+        self.assertEqual(len(self.pages), 5)
+        self.assertTrue(flekky.FlekkyPages())
+
+    def test_slice(self):
+        self.assertEqual(self.pages[1:3], list(self.pages)[1:3])
+        self.assertEqual(self.pages[-1], list(self.pages)[-1])
+
+    def test_by_date(self):
+        self.app.config['FLEKKY_FUTURE'] = True
+        paths = [p.path for p in self.pages.by_date()]
+        self.assertEqual(paths, ['future', 'test'])
+        paths = [p.path for p in self.pages.by_date(reverse=False)]
+        self.assertEqual(paths, ['test', 'future'])
+        self.assertIs(self.pages.by_date(), self.pages.by_date())
+
+    def test_sorted_by(self):
+        titles = [p.meta['title'] for p in self.pages.sorted_by('title')]
+        self.assertEqual(titles, sorted(titles))
+        self.assertEqual(len(titles), 5)
+        self.assertIs(self.pages.sorted_by('title'),
+                      self.pages.sorted_by('title'))
+        self.assertEqual(self.pages.sorted_by('nonexistent'), [])
+
+    def test_next_prev(self):
+        self.app.config['FLEKKY_FUTURE'] = True
+        test = self.pages.get('test')
+        future = self.pages.get('future')
+        self.assertEqual(self.pages.next_page(test), future)
+        self.assertIsNone(self.pages.next_page(future))
+        self.assertEqual(self.pages.prev_page(future), test)
+        self.assertIsNone(self.pages.prev_page(test))
+        self.assertIsNone(self.pages.next_page(self.pages.get('tag/test')))
+
+    def test_next_prev_by_key(self):
+        ordered = self.pages.sorted_by('title')
+        self.assertEqual(
+            self.pages.next_page(ordered[0], key='title'), ordered[1])
+
     def test_tags(self):
         actual = self.pages.values('tags', is_list=True)
         expected = set(['test', 'example'])
@@ -74,6 +162,48 @@ class TestFlekkyPages(TestCase):
         self.assertSetEqual(self.pages.values('category'), set(['greeting']))
 
 
+class TestLazyPages(TestCase):
+    def setUp(self):
+        super(TestLazyPages, self).setUp()
+        self.app.config['FLEKKY_LAZY_PAGES'] = True
+        self.app.config['FLEKKY_LAZY_PAGES_CACHE'] = 2
+        self.lazy_pages = flekky.FlekkyPages(self.app)
+
+    def test_same_pages(self):
+        self.assertEqual([p.path for p in self.lazy_pages],
+                         [p.path for p in self.pages])
+
+    def test_same_content(self):
+        for page in self.pages:
+            lazy_page = self.lazy_pages.get(page.path)
+            self.assertIsInstance(lazy_page, flekky.LazyPage)
+            self.assertEqual(lazy_page.meta, page.meta)
+            self.assertEqual(lazy_page.body, page.body)
+            self.assertEqual(lazy_page.html, page.html)
+
+    def test_bounded(self):
+        for page in self.lazy_pages:
+            page.html
+        self.assertEqual(len(self.lazy_pages._lazy_cache), 2)
+
+
+class TestSite(TestCase):
+    def test_cached(self):
+        with self.app.request_context(ENVIRON):
+            site = flekky._site(self.pages)
+            self.assertIs(flekky._site(self.pages), site)
+            self.assertEqual(site['title'], 'Example')
+
+            self.app.config['FLEKKY_UNPUBLISHED'] = True
+            self.assertIsNot(flekky._site(self.pages), site)
+
+    def test_time(self):
+        time = datetime(2012, 3, 20, 20)
+        self.app.config['FLEKKY_TIME'] = time
+        with self.app.request_context(ENVIRON):
+            self.assertEqual(flekky._site(self.pages)['time'], time)
+
+
 class TestFilters(TestCase):
     dt = datetime(2012, 3, 20, 20)
 
@@ -121,6 +251,1154 @@ class TestFreeze(unittest.TestCase):
         actual = set(self.freezer.all_urls())
         self.assertSetEqual(actual, expected)
 
+    def test_extra_file_conflict(self):
+        dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+
+        class Settings(object):
+            FREEZER_DESTINATION = dirname
+            FREEZER_DESTINATION_IGNORE = ['/lorem ipsum']
+
+        source = os.path.join(root, '_example')
+        freezer = flekky.create_freezer(source, Settings)
+        try:
+            self.assertRaises(ValueError, freezer.freeze)
+        finally:
+            rmtree(dirname)
+
+    def test_hard_link(self):
+        dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        os.makedirs(os.path.join(dirname, 'build', 'test'))
+        other = os.path.join(dirname, 'other.html')
+        with open(other, 'w') as fh:
+            fh.write('other')
+        os.link(other, os.path.join(dirname, 'build', 'test', 'index.html'))
+
+        class Settings(object):
+            FREEZER_DESTINATION = os.path.join(dirname, 'build')
+
+        source = os.path.join(root, '_example')
+        try:
+            flekky.create_freezer(source, Settings).freeze()
+            with open(other) as fh:
+                self.assertEqual(fh.read(), 'other')
+        finally:
+            rmtree(dirname)
+
+
+class TestFeeds(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        copytree(os.path.join(root, '_example'), self.source,
+                 ignore=ignore_patterns('_cache'))
+        with open(os.path.join(self.source, 'pages', 'index.md'), 'w') as fh:
+            fh.write('title: Example\nlayout: index\n'
+                     'url: http://example.com/\n\n')
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def create_app(self, **settings):
+        app = flekky.create_app(self.source, type('Settings', (), settings))
+        return app.test_client()
+
+    def test_sitemap(self):
+        response = self.create_app().get('/sitemap.xml')
+        self.assertEqual(response.mimetype, 'application/xml')
+        self.assertIn(b'<urlset', response.data)
+        self.assertIn(b'<loc>http://example.com/test/</loc>'
+                      b'<lastmod>2012-03-04</lastmod>', response.data)
+        self.assertEqual(response.data.count(b'<url>'), 6)
+
+    def test_sitemap_shards(self):
+        client = self.create_app(FLEKKY_SITEMAP_SIZE=4)
+        response = client.get('/sitemap.xml')
+        self.assertIn(b'<sitemapindex', response.data)
+        self.assertIn(b'http://example.com/sitemap-2.xml', response.data)
+        self.assertNotIn(b'sitemap-3.xml', response.data)
+        first = client.get('/sitemap-1.xml').data
+        second = client.get('/sitemap-2.xml').data
+        self.assertEqual(first.count(b'<url>'), 4)
+        self.assertEqual(second.count(b'<url>'), 2)
+        self.assertEqual(client.get('/sitemap-3.xml').status_code, 404)
+
+    def test_sitemap_shard_urls(self):
+        settings = type('Settings', (), {'FLEKKY_SITEMAP_SIZE': 4})
+        urls = set(flekky.create_freezer(self.source, settings).all_urls())
+        self.assertIn('/sitemap-2.xml', urls)
+        self.assertNotIn('/sitemap-3.xml', urls)
+
+    def test_atom(self):
+        data = self.create_app().get('/atom.xml').data
+        self.assertIn(b'<title>Example</title>', data)
+        self.assertIn(b'<updated>2012-03-04T00:00:00Z</updated>', data)
+        self.assertEqual(data.count(b'<entry>'), 1)
+        self.assertIn(b'&lt;strong&gt;Hello World', data)
+        self.assertIn(b'<author><name>Example</name></author>', data)
+
+    def test_rss(self):
+        data = self.create_app(FLEKKY_FEED_SIZE=0).get('/rss.xml').data
+        self.assertIn(b'<link>http://example.com/</link>', data)
+        self.assertNotIn(b'<item>', data)
+
+    def test_no_base_url(self):
+        source = os.path.join(root, '_example')
+        client = flekky.create_app(source).test_client()
+        for url in ['/sitemap.xml', '/atom.xml', '/rss.xml']:
+            self.assertEqual(client.get(url).status_code, 404)
+        urls = set(flekky.create_freezer(source).all_urls())
+        self.assertNotIn('/sitemap.xml', urls)
+
+    def test_urls(self):
+        urls = set(flekky.create_freezer(self.source).all_urls())
+        self.assertTrue(
+            set(['/sitemap.xml', '/atom.xml', '/rss.xml']) <= urls)
+
+
+class TestTaxonomies(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        copytree(os.path.join(root, '_example'), self.source)
+        os.remove(os.path.join(self.source, 'pages', 'tag', 'example.md'))
+
+        class Settings(object):
+            FLEKKY_TAXONOMIES = {
+                'tags': {'path': 'tag', 'layout': 'tag', 'is_list': True},
+            }
+
+        self.app = flekky.create_app(self.source, Settings)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def test_virtual_pages(self):
+        virtual = flekky.pages.virtual_pages()
+        self.assertEqual([p.path for p in virtual], ['tag/example'])
+        self.assertEqual(virtual[0].meta['title'], 'example')
+        by_key = flekky.pages.by_key('tags', 'example', is_list=True)
+        self.assertEqual(virtual[0].items, list(by_key))
+
+    @unittest.skipUnless(hasattr(sys, 'setswitchinterval'), 'python 3')
+    def test_concurrent_reload(self):
+        missing = []
+
+        def read():
+            for i in range(2000):
+                if flekky.pages.get('tag/example') is None:
+                    missing.append(i)
+
+        # switch threads as often as possible to provoke races
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            thread = threading.Thread(target=read)
+            thread.start()
+            while thread.is_alive():
+                flekky.pages.reload()
+                flekky.pages._state()
+            thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(missing, [])
+
+    def test_not_listed(self):
+        paths = [p.path for p in flekky.pages]
+        self.assertNotIn('tag/example', paths)
+
+    def test_real_page_wins(self):
+        page = flekky.pages.get('tag/test')
+        self.assertNotIsInstance(page, flekky.TaxonomyPage)
+
+    def test_route(self):
+        response = self.client.get('/tag/example/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'lorem ipsum', response.data.lower())
+
+    def test_index_meta(self):
+        with open(os.path.join(self.source, 'pages', 'index.md'), 'w') as fh:
+            fh.write('title: Example\nlayout: index\ntaxonomies:\n'
+                     '  tags:\n    path: tag\n    layout: tag\n'
+                     '    is_list: true\n\n')
+        freezer = flekky.create_freezer(self.source)
+        self.assertIn('/tag/example/', set(freezer.all_urls()))
+
+    def test_incremental_new_member(self):
+        with open(os.path.join(
+                self.source, 'templates', 'layout', 'tag.html'), 'w') as fh:
+            fh.write('{% for item in page.items %}{{ item.title }}\n'
+                     '{% endfor %}')
+        build = os.path.join(self.dirname, 'build')
+
+        class Settings(object):
+            FLEKKY_TAXONOMIES = {
+                'tags': {'path': 'tag', 'layout': 'tag', 'is_list': True},
+            }
+            FLEKKY_INCREMENTAL = True
+            FREEZER_DESTINATION = build
+
+        flekky.create_freezer(self.source, Settings).freeze()
+        with open(os.path.join(self.source, 'pages', 'new.md'), 'w') as fh:
+            fh.write('title: New Post\ntags:\n  - example\n\n')
+        flekky.create_freezer(self.source, Settings).freeze()
+        with open(os.path.join(build, 'tag', 'example', 'index.html')) as fh:
+            self.assertIn('New Post', fh.read())
+
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        copytree(os.path.join(root, '_example'), self.source)
+        with open(os.path.join(self.source, 'pages', 'tag', 'example.md'),
+                  'w') as fh:
+            fh.write('title: example\nlayout: tag\npaginate:\n'
+                     '  key: tags\n  value: example\n  is_list: true\n'
+                     '  per_page: 1\n\n')
+        with open(os.path.join(self.source, 'pages', 'index.md'), 'a') as fh:
+            fh.write('\n')
+        self.app = flekky.create_app(self.source)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def test_paginate(self):
+        pages = flekky.pages
+        with self.app.test_request_context():
+            pagination = pages.paginate(2, 2)
+            self.assertEqual(pagination.total, 5)
+            self.assertEqual(pagination.pages, 3)
+            self.assertEqual(pagination.items, list(pages)[2:4])
+            self.assertTrue(pagination.has_prev)
+            self.assertTrue(pagination.has_next)
+
+    def test_paginate_order(self):
+        paths = [p.path for p in flekky.pages.paginate(1, 10).items]
+        self.assertEqual(paths, sorted(paths))
+
+    def test_paginate_sort(self):
+        pages = flekky.pages
+        for i in range(1, 4):
+            path = os.path.join(self.source, 'pages', 'post%i.md' % i)
+            with open(path, 'w') as fh:
+                fh.write('title: Post\ndate: 2012-01-0%i\ntags: [post]\n\n'
+                         % (4 - i))
+        pages.reload()
+        pagination = pages.paginate(
+            1, 2, 'tags', 'post', is_list=True, sort='date', reverse=True)
+        self.assertEqual(
+            [p.path for p in pagination.items], ['post1', 'post2'])
+        self.assertEqual(pagination.total, 3)
+        pagination = pages.paginate(2, 2, sort='date')
+        self.assertEqual(
+            [p.path for p in pagination.items], ['post1', 'test'])
+
+    def test_paginate_by_key(self):
+        pages = flekky.pages
+        pagination = pages.paginate(2, 1, 'tags', 'example', is_list=True)
+        self.assertEqual(pagination.pages, 2)
+        by_key = pages.by_key('tags', 'example', is_list=True)
+        self.assertEqual(pagination.items, list(by_key)[1:])
+        self.assertFalse(pagination.has_next)
+
+    def test_urls(self):
+        freezer = flekky.create_freezer(self.source)
+        urls = set(freezer.all_urls())
+        self.assertIn('/tag/example/page/2/', urls)
+        self.assertNotIn('/tag/example/page/3/', urls)
+        self.assertNotIn('/tag/test/page/2/', urls)
+
+    def test_route(self):
+        self.assertEqual(self.client.get('/tag/example/').status_code, 200)
+        self.assertEqual(
+            self.client.get('/tag/example/page/2/').status_code, 200)
+        self.assertEqual(
+            self.client.get('/tag/example/page/1/').status_code, 404)
+        self.assertEqual(
+            self.client.get('/tag/example/page/3/').status_code, 404)
+        self.assertEqual(
+            self.client.get('/tag/test/page/2/').status_code, 404)
+
+    def test_real_page(self):
+        for path in ['page/2.md', os.path.join('test', 'page', '2.md')]:
+            path = os.path.join(self.source, 'pages', path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as fh:
+                fh.write('title: Real\ntags: []\n\nreal page\n')
+        flekky.pages.reload()
+        for url in ['/page/2/', '/test/page/2/']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'real page', response.data)
+        self.assertEqual(
+            self.client.get('/test/page/3/').status_code, 404)
+
+        class Settings(object):
+            FREEZER_DESTINATION = os.path.join(self.dirname, 'build')
+
+        flekky.create_freezer(self.source, Settings).freeze()
+        self.assertTrue(os.path.exists(os.path.join(
+            self.dirname, 'build', 'test', 'page', '2', 'index.html')))
+
+    def test_url(self):
+        with self.app.test_request_context():
+            pagination = flekky.pages.paginate_page(
+                flekky.pages.get('tag/example'))
+            self.assertEqual(pagination.next_url, '/tag/example/page/2/')
+            self.assertIsNone(pagination.prev_url)
+            self.assertEqual(pagination.url(1), '/tag/example/')
+
+            pagination = flekky.pages.paginate(2, 1)
+            pagination.path = 'index'
+            self.assertEqual(pagination.url(2), '/page/2/')
+            self.assertEqual(pagination.url(1), '/')
+
+
+class TestProfile(unittest.TestCase):
+    def test_profile(self):
+        dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+
+        class Settings(object):
+            FLEKKY_PROFILE = True
+            FREEZER_DESTINATION = dirname
+
+        source = os.path.join(root, '_example')
+        freezer = flekky.create_freezer(source, Settings)
+        # do not reuse pages (and their html) from other tests
+        flekky.pages._file_cache.clear()
+        flekky.pages.reload()
+        try:
+            freezer.freeze()
+        finally:
+            rmtree(dirname)
+
+        report = freezer.profiler.report()
+        self.assertIn('/test/', report['urls'])
+        self.assertIn('markdown', report['phases'])
+        self.assertIn('template', report['phases'])
+        self.assertEqual(report['templates']['layout/tag.html']['count'], 2)
+        self.assertIn('/test/', freezer.profiler.summary())
+
+    def test_nested_phases(self):
+        profiler = flekky.Profiler()
+        profiler.start_url('/')
+        with profiler.phase('outer'):
+            with profiler.phase('inner'):
+                sleep(0.01)
+        profiler.stop_url()
+        phases = profiler.urls['/']['phases']
+        self.assertGreater(phases['inner'], phases['outer'])
+
+
+class TestIncremental(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        copytree(os.path.join(root, '_example'), self.source)
+        # enable feeds and sitemaps
+        with open(os.path.join(self.source, 'pages', 'index.md'), 'w') as fh:
+            fh.write('title: Example\nlayout: index\n'
+                     'url: http://example.com/\n\n')
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def create_freezer(self):
+        class Settings(object):
+            FLEKKY_INCREMENTAL = True
+            FREEZER_DESTINATION = os.path.join(self.dirname, 'build')
+
+        return flekky.create_freezer(self.source, Settings)
+
+    def freeze(self):
+        self.create_freezer().freeze()
+
+    def fresh(self):
+        cache = self.create_freezer().build_cache
+        cache.load()
+        return set(url for url in cache.entries if cache.is_fresh(url, None))
+
+    def test_unchanged(self):
+        self.freeze()
+        expected = set(['/', '/test/', '/lorem ipsum/', '/tag/test/',
+                        '/tag/example/', '/category/greeting/',
+                        '/sitemap.xml', '/atom.xml', '/rss.xml'])
+        self.assertSetEqual(self.fresh(), expected)
+
+    def test_no_missing_url_generator(self):
+        self.freeze()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.freeze()
+        self.assertEqual([w for w in caught if issubclass(
+            w.category, MissingURLGeneratorWarning)], [])
+
+    def test_config_between_processes(self):
+        # the repr of functions (e.g. FLATPAGES_HTML_RENDERER) contains
+        # their address, which differs between processes
+        code = (
+            'import sys; sys.path.insert(0, %r); from flekky import flekky; '
+            'settings = type("Settings", (), {"FLEKKY_INCREMENTAL": True, '
+            '"FREEZER_DESTINATION": %r}); '
+            'print(flekky.create_freezer(%r, settings).build_cache._config())'
+        ) % (root, os.path.join(self.dirname, 'build'), self.source)
+        configs = [subprocess.check_output([sys.executable, '-c', code])
+                   for i in range(2)]
+        self.assertEqual(configs[0], configs[1])
+
+    def test_profile(self):
+        class Settings(object):
+            FLEKKY_INCREMENTAL = True
+            FLEKKY_PROFILE = True
+            FREEZER_DESTINATION = os.path.join(self.dirname, 'build')
+
+        self.freeze()
+        freezer = flekky.create_freezer(self.source, Settings)
+        freezer.freeze()
+        # profiling does not invalidate the cache
+        caches = freezer.profiler.report()['caches']
+        self.assertEqual(caches['build_cache']['hits'], 9)
+
+    def test_changed_page(self):
+        self.freeze()
+        with open(os.path.join(self.source, 'pages', 'lorem ipsum.md'),
+                  'a') as fh:
+            fh.write('\nchanged\n')
+        self.assertSetEqual(self.fresh(), set([
+            '/test/', '/tag/test/', '/category/greeting/']))
+
+    def test_changed_template(self):
+        self.freeze()
+        with open(os.path.join(
+                self.source, 'templates', 'layout', 'tag.html'), 'a') as fh:
+            fh.write('\nchanged\n')
+        self.assertSetEqual(self.fresh(), set([
+            '/', '/test/', '/lorem ipsum/', '/category/greeting/',
+            '/sitemap.xml', '/atom.xml', '/rss.xml']))
+
+    def test_removed_page(self):
+        self.freeze()
+        os.unlink(os.path.join(self.source, 'pages', 'tag', 'test.md'))
+        self.freeze()
+        build = os.path.join(self.dirname, 'build')
+        self.assertFalse(os.path.exists(os.path.join(build, 'tag', 'test')))
+        self.assertTrue(os.path.exists(os.path.join(build, 'tag', 'example')))
+
+
+class TestCompress(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        self.build = os.path.join(self.dirname, 'build')
+        copytree(os.path.join(root, '_example'), self.source,
+                 ignore=ignore_patterns('_cache'))
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def freeze(self, jobs=1):
+        class Settings(object):
+            FLEKKY_COMPRESS = True
+            FLEKKY_JOBS = jobs
+            FREEZER_DESTINATION = self.build
+
+        flekky.create_freezer(self.source, Settings).freeze()
+
+    def test_compress(self):
+        self.freeze()
+        path = os.path.join(self.build, 'test', 'index.html')
+        with open(path, 'rb') as fh:
+            content = fh.read()
+        with gzip.open(path + '.gz', 'rb') as fh:
+            self.assertEqual(fh.read(), content)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.build, 'static', 'css', 'style.css.gz')))
+
+    def test_parallel(self):
+        self.freeze(jobs=2)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.build, 'test', 'index.html.gz')))
+
+    def test_unchanged(self):
+        self.freeze()
+        path = os.path.join(self.build, 'static', 'css', 'style.css.gz')
+        os.utime(path, (1, 1))
+        self.freeze()
+        self.assertEqual(os.path.getmtime(path), 1)
+
+    def test_removed_page(self):
+        self.freeze()
+        os.unlink(os.path.join(self.source, 'pages', 'tag', 'test.md'))
+        self.freeze()
+        self.assertFalse(os.path.exists(
+            os.path.join(self.build, 'tag', 'test', 'index.html.gz')))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.build, 'tag', 'example', 'index.html.gz')))
+
+
+class TestFingerprint(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        self.build = os.path.join(self.dirname, 'build')
+        copytree(os.path.join(root, '_example'), self.source,
+                 ignore=ignore_patterns('_cache'))
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def create_freezer(self):
+        class Settings(object):
+            FLEKKY_FINGERPRINT = True
+            FREEZER_DESTINATION = self.build
+
+        return flekky.create_freezer(self.source, Settings)
+
+    def test_freeze(self):
+        self.create_freezer().freeze()
+        with open(os.path.join(self.build, 'static', 'manifest.json')) as fh:
+            manifest = json.load(fh)
+        hashed = manifest['css/style.css']
+        self.assertTrue(re.match(r'^css/style\.[0-9a-f]{10}\.css$', hashed))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.build, 'static', hashed)))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.build, 'static', 'css', 'style.css')))
+        with open(os.path.join(self.build, 'test', 'index.html')) as fh:
+            self.assertIn('/static/' + hashed, fh.read())
+
+    def test_serve(self):
+        freezer = self.create_freezer()
+        manifest = freezer.app.extensions['flekky_static'].manifest()
+        client = freezer.app.test_client()
+        response = client.get('/static/' + manifest['css/style.css'])
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_cached_hash(self):
+        self.create_freezer()
+        cache_file = os.path.join(self.source, '_cache', 'static.json')
+        with open(cache_file) as fh:
+            cached = json.load(fh)
+        cached['css/style.css'][2] = 'f' * 40
+        with open(cache_file, 'w') as fh:
+            json.dump(cached, fh)
+
+        manifest = self.create_freezer().app.extensions['flekky_static']
+        self.assertEqual(
+            manifest.filename('css/style.css'), 'css/style.ffffffffff.css')
+
+        with open(os.path.join(self.source, 'static', 'css', 'style.css'),
+                  'a') as fh:
+            fh.write('\n/* changed */\n')
+        manifest = self.create_freezer().app.extensions['flekky_static']
+        self.assertNotEqual(
+            manifest.filename('css/style.css'), 'css/style.ffffffffff.css')
+
+
+class TestImages(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        self.build = os.path.join(self.dirname, 'build')
+        copytree(os.path.join(root, '_example'), self.source,
+                 ignore=ignore_patterns('_cache'))
+        with open(os.path.join(
+                self.source, 'templates', 'layout', 'photo.html'), 'w') as fh:
+            fh.write('{{ "img/photo.png"|responsive_image(alt="A & B") }}')
+        with open(os.path.join(self.source, 'pages', 'photo.md'), 'w') as fh:
+            fh.write('title: Photo\nlayout: photo\n\n')
+        if Image is not None:
+            os.mkdir(os.path.join(self.source, 'static', 'img'))
+            Image.new('RGB', (1000, 500), (255, 0, 0)).save(
+                os.path.join(self.source, 'static', 'img', 'photo.png'))
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def create_freezer(self):
+        class Settings(object):
+            FREEZER_DESTINATION = self.build
+            FLEKKY_IMAGE_WIDTHS = [320, 640]
+
+        return flekky.create_freezer(self.source, Settings)
+
+    def get_variants(self):
+        return sorted(
+            os.path.relpath(os.path.join(dirpath, filename), self.build)
+            for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.build, 'images'))
+            for filename in filenames)
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_markup(self):
+        app = self.create_freezer().app
+        with app.test_request_context():
+            html = flekky.filter_responsive_image(
+                None, 'img/photo.png', alt='A & B', sizes='50vw')
+        formats = app.extensions['flekky_images'].formats
+        self.assertIn(
+            '<img src="/images/img/photo.png/1000.png" srcset="'
+            '/images/img/photo.png/320.png 320w, '
+            '/images/img/photo.png/640.png 640w, '
+            '/images/img/photo.png/1000.png 1000w" sizes="50vw" '
+            'width="1000" height="500" alt="A &amp; B">', html)
+        if 'webp' in formats:
+            self.assertTrue(html.startswith(
+                '<picture><source type="image/webp" '
+                'srcset="/images/img/photo.png/320.webp 320w, '))
+
+    def test_fallback(self):
+        app = self.create_freezer().app
+        with app.test_request_context():
+            html = flekky.filter_responsive_image(
+                None, 'css/style.css', alt='x')
+        self.assertEqual(html, '<img src="/static/css/style.css" alt="x">')
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_freeze(self):
+        self.create_freezer().freeze()
+        variants = self.get_variants()
+        self.assertIn(os.path.join('images', 'img', 'photo.png', '320.png'),
+                      variants)
+        self.assertIn(os.path.join('images', 'img', 'photo.png', '1000.png'),
+                      variants)
+        image = Image.open(os.path.join(
+            self.build, 'images', 'img', 'photo.png', '640.png'))
+        self.assertEqual(image.size, (640, 320))
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_cache(self):
+        self.create_freezer().freeze()
+        directory = os.path.join(self.source, '_cache', 'images')
+        cached = set(os.listdir(directory))
+        self.assertIn('images.json', cached)
+
+        # unchanged images are not encoded again
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename != 'images.json':
+                    with open(os.path.join(dirpath, filename), 'wb') as fh:
+                        fh.write(b'cached')
+        self.create_freezer().freeze()
+        with open(os.path.join(
+                self.build, 'images', 'img', 'photo.png', '320.png'),
+                'rb') as fh:
+            self.assertEqual(fh.read(), b'cached')
+
+        # changed images are
+        Image.new('RGB', (800, 400), (0, 0, 255)).save(
+            os.path.join(self.source, 'static', 'img', 'photo.png'))
+        self.create_freezer().freeze()
+        image = Image.open(os.path.join(
+            self.build, 'images', 'img', 'photo.png', '320.png'))
+        self.assertEqual(image.size, (320, 160))
+        self.assertIn(os.path.join('images', 'img', 'photo.png', '800.png'),
+                      self.get_variants())
+
+    @unittest.skipIf(Image is None, 'Pillow is not installed')
+    def test_incremental(self):
+        class Settings(object):
+            FREEZER_DESTINATION = self.build
+            FLEKKY_IMAGE_WIDTHS = [320, 640]
+            FLEKKY_INCREMENTAL = True
+
+        flekky.create_freezer(self.source, Settings).freeze()
+        variants = self.get_variants()
+        # the page is skipped, but its images are kept
+        flekky.create_freezer(self.source, Settings).freeze()
+        self.assertEqual(self.get_variants(), variants)
+
+    def test_not_found(self):
+        client = self.create_freezer().app.test_client()
+        response = client.get('/images/img/photo.png/123.png')
+        self.assertEqual(response.status_code, 404)
+        response = client.get('/images/img/missing.png/320.png')
+        self.assertEqual(response.status_code, 404)
+
+
+class TestMinify(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        self.build = os.path.join(self.dirname, 'build')
+        copytree(os.path.join(root, '_example'), self.source,
+                 ignore=ignore_patterns('_cache'))
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def test_html(self):
+        html = ('<p>foo   bar\n\n  baz</p> <!-- comment -->\n'
+                '<!--[if IE]>ie<![endif]-->'
+                '<pre>  a\n  b</pre><a title="a  b">x</a>')
+        self.assertEqual(
+            flekky.minify_html(html),
+            '<p>foo bar\nbaz</p> \n<!--[if IE]>ie<![endif]-->'
+            '<pre>  a\n  b</pre><a title="a  b">x</a>')
+
+    def test_html_style(self):
+        html = '<style>\n  a ,  b { color: red; }\n</style>'
+        self.assertEqual(
+            flekky.minify_html(html), '<style>a,b{color: red}</style>')
+
+    def test_css(self):
+        css = ('/*! license */\na > b {\n  content: "a ; }";\n'
+               '  /* comment */\n  color: red;\n}\n')
+        self.assertEqual(
+            flekky.minify_css(css),
+            '/*! license */ a>b{content: "a ; }";color: red}')
+
+    def test_css_comments(self):
+        css = 'a /* x */ b { x: y ;; /* c */ } c{d:e;}'
+        self.assertEqual(flekky.minify_css(css), 'a b{x: y}c{d:e}')
+
+    def test_freeze(self):
+        class Settings(object):
+            FLEKKY_MINIFY = True
+            FREEZER_DESTINATION = self.build
+
+        flekky.create_freezer(self.source, Settings).freeze()
+        with open(os.path.join(self.build, 'test', 'index.html')) as fh:
+            html = fh.read()
+        self.assertNotIn('  ', html)
+        path = os.path.join(self.build, 'static', 'css', 'style.css')
+        with open(path) as fh:
+            self.assertNotIn('\n', fh.read())
+        cache = os.path.join(self.source, '_cache', 'minify')
+        self.assertTrue(os.listdir(cache))
+
+
+class TestShard(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        os.mkdir(self.dirname)
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def freeze(self, name, shard=None):
+        class Settings(object):
+            FLEKKY_SHARD = shard
+            FLEKKY_TIME = datetime(2000, 1, 1)
+            FREEZER_DESTINATION = os.path.join(self.dirname, name)
+
+        source = os.path.join(root, '_example')
+        return flekky.create_freezer(source, Settings).freeze()
+
+    def list_files(self, name):
+        base = os.path.join(self.dirname, name)
+        return set(
+            os.path.relpath(os.path.join(dirpath, filename), base)
+            for dirpath, dirnames, filenames in os.walk(base)
+            for filename in filenames)
+
+    def test_partition(self):
+        urls = self.freeze('full')
+        first = self.freeze('shard1', (1, 2))
+        second = self.freeze('shard2', (2, 2))
+        self.assertTrue(first)
+        self.assertTrue(second)
+        self.assertEqual(first | second, urls)
+        self.assertEqual(first & second, set())
+
+    def test_merge(self):
+        self.freeze('full')
+        self.freeze('shard1', (1, 2))
+        self.freeze('shard2', (2, 2))
+        shards = [os.path.join(self.dirname, name)
+                  for name in ['shard1', 'shard2']]
+        merged = os.path.join(self.dirname, 'merged')
+        self.assertEqual(flekky.merge_shards(shards, merged), [])
+        self.assertEqual(self.list_files('merged'), self.list_files('full'))
+
+    def test_conflict(self):
+        self.freeze('shard1', (1, 2))
+        self.freeze('shard2', (2, 2))
+        shards = []
+        for name in ['shard1', 'shard2']:
+            shards.append(os.path.join(self.dirname, name))
+            with open(os.path.join(shards[-1], 'robots.txt'), 'w') as fh:
+                fh.write(name)
+        merged = os.path.join(self.dirname, 'merged')
+        self.assertEqual(
+            flekky.merge_shards(shards, merged), ['robots.txt'])
+        self.assertFalse(os.path.exists(merged))
+
+    def test_missing_shard(self):
+        self.freeze('shard1', (1, 2))
+        self.assertRaises(
+            ValueError, flekky.merge_shards,
+            [os.path.join(self.dirname, 'shard1')],
+            os.path.join(self.dirname, 'merged'))
+
+    def test_url_shard(self):
+        self.assertEqual(flekky.url_shard('/test/', 4),
+                         flekky.url_shard('/test/', 4))
+        self.assertIn(flekky.url_shard('/test/', 4), [1, 2, 3, 4])
+
+
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        os.mkdir(self.dirname)
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def create_app(self):
+        self.rendered = []
+
+        def renderer(body):
+            self.rendered.append(body)
+            return '<p>%s</p>' % body
+
+        class Settings(object):
+            FLEKKY_SEARCH = True
+            FLEKKY_CACHE_DIR = self.dirname
+            FLATPAGES_HTML_RENDERER = renderer
+            FREEZER_DESTINATION = os.path.join(self.dirname, 'build')
+
+        app = flekky.create_app(os.path.join(root, '_example'), Settings)
+        # do not reuse pages (and their html) from other tests
+        flekky.pages._file_cache.clear()
+        flekky.pages.reload()
+        return app
+
+    def test_tokenize(self):
+        html = ('<p class="x">Hello <b>world</b>, hello &amp; a</p>'
+                '<script>var ignored;</script>')
+        self.assertEqual(flekky.tokenize(html), {'hello': 2, 'world': 1})
+
+    def test_routes(self):
+        client = self.create_app().test_client()
+        docs = json.loads(client.get('/search/pages.json').data)
+        self.assertIn(['/test/', 'Hello World'], docs)
+        terms = json.loads(client.get('/search/terms/he.json').data)
+        doc = docs.index(['/test/', 'Hello World'])
+        self.assertIn([doc, 2], terms['hello'])
+        self.assertEqual(
+            client.get('/search/terms/zz.json').status_code, 404)
+
+    def test_disabled(self):
+        app = flekky.create_app(os.path.join(root, '_example'))
+        response = app.test_client().get('/search/pages.json')
+        self.assertNotEqual(response.status_code, 200)
+
+    def test_reuse(self):
+        with self.create_app().test_request_context():
+            flekky.search_index()
+        self.assertTrue(self.rendered)
+        with self.create_app().test_request_context():
+            index = flekky.search_index()
+        self.assertEqual(self.rendered, [])
+        self.assertIn('hello', index.shards['he'])
+
+    def test_urls(self):
+        app = self.create_app()
+        freezer = flekky.FlekkyFreezer(app)
+        self.assertIn('/search/pages.json', set(freezer.all_urls()))
+        urls = set(flekky.create_freezer(
+            os.path.join(root, '_example'),
+            type('Settings', (), {
+                'FLEKKY_SEARCH': True,
+                'FLEKKY_CACHE_DIR': self.dirname,
+            })).all_urls())
+        self.assertIn('/search/terms/he.json', urls)
+
+
+class TestParallel(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        os.mkdir(self.dirname)
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def freeze(self, name, jobs):
+        class Settings(object):
+            FLEKKY_JOBS = jobs
+            FREEZER_DESTINATION = os.path.join(self.dirname, name)
+
+        source = os.path.join(root, '_example')
+        return flekky.create_freezer(source, Settings).freeze()
+
+    def read_all(self, name):
+        files = {}
+        base = os.path.join(self.dirname, name)
+        for dirpath, dirnames, filenames in os.walk(base):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with open(path, 'rb') as fh:
+                    content = fh.read()
+                # the build time is not reproducible
+                content = re.sub(b'<time[^>]*>[^<]*</time>', b'', content)
+                files[os.path.relpath(path, base)] = content
+        return files
+
+    def test_parallel(self):
+        serial = self.freeze('serial', 1)
+        parallel = self.freeze('parallel', 2)
+        self.assertSetEqual(serial, parallel)
+        self.assertEqual(self.read_all('serial'), self.read_all('parallel'))
+
+
+class TestHtmlCache(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        os.mkdir(self.dirname)
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def create_pages(self):
+        self.rendered = []
+
+        def renderer(body):
+            self.rendered.append(body)
+            return '<p>%s</p>' % body
+
+        class Settings(object):
+            FLEKKY_HTML_CACHE = True
+            FLEKKY_CACHE_DIR = self.dirname
+            FLATPAGES_HTML_RENDERER = renderer
+
+        source = os.path.join(root, '_example')
+        app = flekky.create_app(source, Settings)
+        return flekky.FlekkyPages(app)
+
+    def test_cached(self):
+        html = self.create_pages().get('test').html
+        self.assertEqual(len(self.rendered), 1)
+
+        self.assertEqual(self.create_pages().get('test').html, html)
+        self.assertEqual(len(self.rendered), 0)
+
+    def test_evict(self):
+        cache = flekky.HtmlCache(self.dirname, 10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+        os.utime(os.path.join(self.dirname, 'a.html'), (1, 1))
+        os.utime(os.path.join(self.dirname, 'b.html'), (2, 2))
+        self.assertEqual(cache.get('a'), '12345')
+        cache.set('c', '12345')
+        self.assertEqual(cache.get('a'), '12345')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), '12345')
+
+    def test_threads(self):
+        cache = flekky.HtmlCache(self.dirname, 1000000)
+        errors = []
+
+        def write():
+            try:
+                for i in range(200):
+                    cache.set('a', '12345' * 100)
+            except (IOError, OSError) as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=write) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(cache.get('a'), '12345' * 100)
+
+
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        copytree(os.path.join(root, '_example'), self.source,
+                 ignore=ignore_patterns('_cache'))
+        self.cache = os.path.join(self.source, '_cache', 'templates')
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def create_app(self, **settings):
+        settings.setdefault('FLEKKY_TEMPLATE_CACHE', True)
+        return flekky.create_app(
+            self.source, type('Settings', (), settings))
+
+    def test_warm(self):
+        app = self.create_app()
+        templates, rendered = flekky.warm(app)
+        self.assertEqual(templates, len(app.jinja_env.list_templates()))
+        self.assertEqual(rendered, 0)
+        self.assertEqual(len(os.listdir(self.cache)), templates)
+
+    def test_warm_html_cache(self):
+        app = self.create_app(FLEKKY_HTML_CACHE=True)
+        templates, rendered = flekky.warm(app)
+        self.assertEqual(rendered, len(flekky.pages._pages))
+        html_cache = os.path.join(self.source, '_cache', 'html')
+        # pages with the same content share a cache entry
+        self.assertTrue(os.listdir(html_cache))
+
+    def test_changed_template(self):
+        flekky.warm(self.create_app())
+        with open(os.path.join(
+                self.source, 'templates', 'base.html'), 'a') as fh:
+            fh.write('changed template')
+        client = self.create_app().test_client()
+        self.assertIn(b'changed template', client.get('/test/').data)
+
+    def test_disabled(self):
+        flekky.warm(self.create_app(FLEKKY_TEMPLATE_CACHE=False))
+        self.assertFalse(os.path.exists(self.cache))
+
+    def test_not_writable(self):
+        # a file where the cache directory should be
+        with open(os.path.join(self.source, '_cache'), 'w') as fh:
+            fh.write('')
+        client = self.create_app().test_client()
+        self.assertEqual(client.get('/test/').status_code, 200)
+        self.assertEqual(client.get('/test/').status_code, 200)
+
+
+class TestWatch(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        copytree(os.path.join(root, '_example'), self.source)
+        self.app = flekky.create_app(self.source)
+        self.watcher, self.live_reload = flekky.watch(self.app, self.source)
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def test_update(self):
+        pages = flekky.pages
+        self.assertIsNone(pages.get('new'))
+
+        path = os.path.join(self.source, 'pages', 'new.md')
+        with open(path, 'w') as fh:
+            fh.write('title: New\n\nnew page\n')
+        pages.update([path])
+        self.assertEqual(pages.get('new').meta['title'], 'New')
+
+        os.unlink(path)
+        pages.update([path])
+        self.assertIsNone(pages.get('new'))
+
+    def test_update_ignores_other_files(self):
+        pages = flekky.pages
+        pages.reload = lambda: self.fail('all pages were reloaded')
+        try:
+            pages.update([
+                os.path.join(self.source, 'pages', '.test.md.swp'),
+                os.path.join(self.source, 'pages', 'test.md~'),
+                os.path.join(self.source, 'pages', '4913'),
+            ])
+        finally:
+            del pages.reload
+
+    def test_update_directory(self):
+        pages = flekky.pages
+        self.assertIsNotNone(pages.get('tag/test'))
+        rmtree(os.path.join(self.source, 'pages', 'tag'))
+        pages.update([os.path.join(self.source, 'pages', 'tag')])
+        self.assertIsNone(pages.get('tag/test'))
+
+    def test_check(self):
+        changes = []
+        watcher = flekky.Watcher(
+            [os.path.join(self.source, 'pages')], changes.append)
+        watcher.check()
+        del changes[:]
+
+        path = os.path.join(self.source, 'pages', 'new.md')
+        with open(path, 'w') as fh:
+            fh.write('title: New\n\nnew page\n')
+        watcher.check()
+        self.assertEqual(changes, [[path]])
+
+    def test_events(self):
+        events = self.live_reload.events()
+        self.live_reload.timeout = 0
+        self.assertEqual(next(events), ': ping\n\n')
+        self.live_reload.notify()
+        self.assertEqual(next(events), 'data: reload\n\n')
+
+    def test_inject(self):
+        client = self.app.test_client()
+        html = client.get('/test/').get_data(as_text=True)
+        self.assertIn(self.live_reload.script, html)
+
+    def test_response_cache(self):
+        client = self.app.test_client()
+        first = client.get('/test/').get_data(as_text=True)
+
+        path = os.path.join(self.source, 'templates', 'base.html')
+        with open(path, 'a') as fh:
+            fh.write('changed template')
+        second = client.get('/test/').get_data(as_text=True)
+        self.assertEqual(first, second)
+        self.assertEqual(second.count(self.live_reload.script), 1)
+
+        self.live_reload.notify()
+        third = client.get('/test/').get_data(as_text=True)
+        self.assertIn('changed template', third)
+
+    @unittest.skipUnless(hasattr(sys, 'setswitchinterval'), 'python 3')
+    def test_response_cache_concurrent(self):
+        os.remove(os.path.join(self.source, 'pages', 'tag', 'example.md'))
+
+        class Settings(object):
+            FLEKKY_TAXONOMIES = {
+                'tags': {'path': 'tag', 'layout': 'tag', 'is_list': True},
+            }
+
+        app = flekky.create_app(self.source, Settings)
+        watcher, live_reload = flekky.watch(app, self.source)
+        client = app.test_client()
+        statuses = set()
+
+        def read():
+            for i in range(500):
+                statuses.add(client.get('/tag/example/').status_code)
+
+        # switch threads as often as possible to provoke races
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            thread = threading.Thread(target=read)
+            thread.start()
+            while thread.is_alive():
+                flekky.pages.reload()
+                flekky.pages._state()
+                live_reload.notify()
+            thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+        self.assertEqual(statuses, set([200]))
+
+    def test_etag(self):
+        client = self.app.test_client()
+        response = client.get('/test/')
+        etag = response.headers['ETag']
+        self.assertFalse(etag.startswith('W/'))
+
+        response = client.get('/test/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        self.live_reload.notify()
+        response = client.get('/test/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        with open(os.path.join(self.source, 'pages', 'test.md'), 'a') as fh:
+            fh.write('\nchanged\n')
+        flekky.pages.update([os.path.join(self.source, 'pages', 'test.md')])
+        self.live_reload.notify()
+        response = client.get('/test/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
 
 class TestArgs(unittest.TestCase):
     def setUp(self):
@@ -160,6 +1438,31 @@ class TestArgs(unittest.TestCase):
         self.assertFalse(args.FLEKKY_FUTURE)
         self.assertFalse(args.FLEKKY_UNPUBLISHED)
         self.assertIsNone(args.destination)
+        self.assertFalse(args.FLEKKY_INCREMENTAL)
+        self.assertEqual(args.FLEKKY_JOBS, 1)
+
+    def test_build_shard(self):
+        args = flekky.parse_args(['build', '--shard', '2/3'])
+        self.assertEqual(args.FLEKKY_SHARD, (2, 3))
+        self.assertRaises(
+            SystemExit, flekky.parse_args, ['build', '--shard', '4/3'])
+        self.assertRaises(
+            SystemExit, flekky.parse_args, ['build', '--shard', 'foo'])
+
+    def test_merge(self):
+        args = flekky.parse_args(['merge', 'a', 'b', '-d', 'c'])
+        self.assertEqual(args.cmd, 'merge')
+        self.assertEqual(args.shards, ['a', 'b'])
+        self.assertEqual(args.destination, 'c')
+
+    def test_build_jobs(self):
+        args = flekky.parse_args(['build', '--jobs', '4'])
+        self.assertEqual(args.FLEKKY_JOBS, 4)
+
+    def test_warm(self):
+        args = flekky.parse_args(['--html-cache', 'warm'])
+        self.assertEqual(args.cmd, 'warm')
+        self.assertTrue(args.FLEKKY_HTML_CACHE)
 
     def test_invalid_cmd(self):
         self.assertRaises(SystemExit, flekky.parse_args, ['invalid'])
@@ -169,6 +1472,15 @@ class TestArgs(unittest.TestCase):
         self.assertRaises(SystemExit, flekky.parse_args, ['-h'])
         self.assertTrue(self.get_out().startswith('usage'))
 
+    def test_cli_is_lightweight(self):
+        code = ('import sys, flekky.cli; print(sorted(m for m in sys.modules '
+                'if m.split(".")[0] in %r))' % (
+                    ['flask', 'flask_flatpages', 'flask_frozen', 'jinja2',
+                     'werkzeug', 'markdown', 'pkg_resources'],))
+        out = subprocess.check_output(
+            [sys.executable, '-c', code], cwd=root)
+        self.assertEqual(out.decode('utf-8').strip(), '[]')
+
 
 class TestRLink(unittest.TestCase):
     def setUp(self):
@@ -258,6 +1570,77 @@ class TestRLink(unittest.TestCase):
         self.assertTrue(os.path.isdir(os.path.join(src, 'dir')))
 
 
+class TestSyncExtraFiles(unittest.TestCase):
+    def setUp(self):
+        self.dirname = os.path.abspath('.tmp_%i' % randint(1000, 10000))
+        self.source = os.path.join(self.dirname, 'source')
+        self.destination = os.path.join(self.dirname, 'build')
+        self.manifest = os.path.join(self.source, '_cache', 'extra.json')
+        os.makedirs(os.path.join(self.source, 'dir', 'sub'))
+        os.makedirs(os.path.join(self.source, 'pages'))
+        os.makedirs(self.destination)
+        for path in ['file', 'dir/file', 'dir/sub/file', 'pages/index.md',
+                     '_hidden']:
+            with open(os.path.join(self.source, path), 'w') as fh:
+                fh.write(path)
+
+    def tearDown(self):
+        rmtree(self.dirname)
+
+    def sync(self):
+        return flekky.sync_extra_files(
+            self.source, self.destination, self.manifest)
+
+    def test_extra_files(self):
+        self.assertEqual(flekky.extra_files(self.source), ['dir', 'file'])
+
+    def test_sync(self):
+        self.assertEqual(self.sync(), (3, 0))
+        self.assertTrue(os.path.samefile(
+            os.path.join(self.source, 'dir', 'sub', 'file'),
+            os.path.join(self.destination, 'dir', 'sub', 'file')))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.destination, 'pages')))
+        self.assertEqual(self.sync(), (0, 0))
+
+    def test_sync_changed(self):
+        self.sync()
+        path = os.path.join(self.source, 'file')
+        os.unlink(path)
+        with open(path, 'w') as fh:
+            fh.write('changed')
+        self.assertEqual(self.sync(), (1, 0))
+        self.assertTrue(os.path.samefile(
+            path, os.path.join(self.destination, 'file')))
+
+    def test_sync_removed(self):
+        self.sync()
+        rmtree(os.path.join(self.source, 'dir', 'sub'))
+        self.assertEqual(self.sync(), (0, 1))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.destination, 'dir', 'sub')))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.destination, 'dir', 'file')))
+
+    def test_link_fallback(self):
+        def fail(src, dest):
+            raise OSError(errno.EXDEV, 'Invalid cross-device link')
+
+        _link = os.link
+        os.link = fail
+        try:
+            self.sync()
+        finally:
+            os.link = _link
+
+        src = os.path.join(self.source, 'file')
+        dest = os.path.join(self.destination, 'file')
+        self.assertFalse(os.path.samefile(src, dest))
+        with open(dest) as fh:
+            self.assertEqual(fh.read(), 'file')
+        self.assertEqual(os.path.getmtime(src), os.path.getmtime(dest))
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,5 +1,7 @@
 import unittest
 
+from flask_flatpages import Page
+
 from flekky.flekky import shift_headings
 
 
@@ -39,3 +41,28 @@ class TestShiftHeadings(unittest.TestCase):
             '<div><h4>baz</h4></div>', -2)
         self.assertEqual(actual, '<h1>test</h1><h1>foo</h1>'
             '<div><h2>baz</h2></div>')
+
+    def test_h6_unshift_1(self):
+        actual = shift_headings('<h6>test</h6>', -1)
+        self.assertEqual(actual, '<h5>test</h5>')
+
+    def test_attributes(self):
+        actual = shift_headings('<H1 id="foo">test</H1>', 1)
+        self.assertEqual(actual, '<h2 id="foo">test</h2>')
+
+    def test_similar_tags(self):
+        actual = shift_headings('<hr><h1>test</h1><header></header>', 1)
+        self.assertEqual(actual, '<hr><h2>test</h2><header></header>')
+
+    def test_untouched(self):
+        html = ('<!-- <h1> --><script>"<h1>"</script>'
+            '<a title="<h1>">test</a>')
+        self.assertEqual(shift_headings(html, 1), html)
+
+    def test_fix_outline_cache(self):
+        page = Page('test', '', '', lambda page: '<h1>test</h1>')
+        self.assertEqual(page.fix_outline(2), '<h2>test</h2>')
+        self.assertIs(page.fix_outline(2), page.fix_outline(2))
+
+        page.html = '<h2>test</h2>'
+        self.assertEqual(page.fix_outline(2), '<h3>test</h3>')